@@ -0,0 +1,184 @@
+import sys
+import logging
+import argparse
+from pathlib import Path
+
+import torch
+from transformers import AutoConfig
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+BACKENDS = ('eager', 'quantized', 'torchscript', 'onnx')
+EXPORTED_SUFFIXES = {'torchscript': '.pt', 'onnx': '.onnx'}
+
+class ModelOutputs(dict):
+    """What outputs_to_objects reads from the transformers outputs: .logits and ['pred_boxes']."""
+
+    def __init__(self, logits, pred_boxes):
+        super().__init__(logits=logits, pred_boxes=pred_boxes)
+
+    @property
+    def logits(self):
+        return self['logits']
+
+class OutputsAdapter(torch.nn.Module):
+    # Exported graphs can only return plain tensors
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes
+
+class ExportedModel:
+    """Runs an exported graph like the transformers model it came from (same config, same outputs)."""
+
+    def __init__(self, run, model_config, resident_bytes):
+        self.run = run
+        self.config = model_config
+        self.resident_bytes = resident_bytes
+
+    def __call__(self, pixel_values, pixel_mask=None):
+        if pixel_mask is None:
+            pixel_mask = torch.ones((pixel_values.shape[0], *pixel_values.shape[2:]), dtype=torch.long)
+        logits, pred_boxes = self.run(pixel_values, pixel_mask)
+        return ModelOutputs(logits, pred_boxes)
+
+def get_exported_path(name, backend):
+    return Path(config.EXPORTED_MODELS_DIR) / f'{name}{EXPORTED_SUFFIXES[backend]}'
+
+def get_resident_bytes(model):
+    if isinstance(model, ExportedModel):
+        return model.resident_bytes
+    # state_dict instead of parameters(): int8 weights are packed outside of the parameters
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+def quantize(model):
+    # Dynamic int8 quantization of the linear layers (most of the DETR transformer); convolutions stay fp32
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_exported(name, backend):
+    path = get_exported_path(name, backend)
+    if not path.exists():
+        raise FileNotFoundError(f'{path} not found, export it first with "python accelerated.py export --backend {backend}"')
+    model_config = AutoConfig.from_pretrained(path.parent / name)
+    if backend == 'torchscript':
+        module = torch.jit.load(str(path), map_location='cpu')
+        module.eval()
+        return ExportedModel(module, model_config, get_resident_bytes(module))
+
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError('INFERENCE_BACKEND "onnx" needs onnxruntime ("poetry install --extras onnx")') from e
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = onnxruntime.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+
+    def run(pixel_values, pixel_mask):
+        logits, pred_boxes = session.run(['logits', 'pred_boxes'], {
+            'pixel_values': pixel_values.cpu().numpy(), 'pixel_mask': pixel_mask.cpu().numpy()})
+        return torch.from_numpy(logits), torch.from_numpy(pred_boxes)
+    return ExportedModel(run, model_config, path.stat().st_size)
+
+def export(names, backends):
+    from model_registry import MODEL_SPECS
+    directory = Path(config.EXPORTED_MODELS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        model_class, model_id, revision, size = MODEL_SPECS[name]
+        model = model_class.from_pretrained(model_id, revision=revision)
+        model.eval()
+        model.config.save_pretrained(directory / name)
+        adapter = OutputsAdapter(model)
+        # Non-square, batch of 2 and partly masked, so padded batches of any page size go through the same graph
+        pixel_values = torch.rand((2, 3, size, int(size * 0.75)))
+        pixel_mask = torch.ones((2, size, int(size * 0.75)), dtype=torch.long)
+        pixel_mask[1, size // 2:] = 0
+        for backend in backends:
+            path = get_exported_path(name, backend)
+            with torch.no_grad():
+                if backend == 'torchscript':
+                    torch.jit.trace(adapter, (pixel_values, pixel_mask), check_trace=False).save(str(path))
+                else:
+                    torch.onnx.export(
+                        adapter, (pixel_values, pixel_mask), str(path),
+                        input_names=['pixel_values', 'pixel_mask'], output_names=['logits', 'pred_boxes'],
+                        dynamic_axes={'pixel_values': {0: 'batch', 2: 'height', 3: 'width'},
+                                      'pixel_mask': {0: 'batch', 1: 'height', 2: 'width'},
+                                      'logits': {0: 'batch'}, 'pred_boxes': {0: 'batch'}},
+                        opset_version=17)
+            logger.info(f'Exported {name} model to {path}')
+
+def compare_objects(reference, candidate, size, labels):
+    """Largest difference (fraction of the image size) between each reference box and the closest candidate box
+    of the same label, considering only the given labels. A reference box without a counterpart counts as 1."""
+    width, height = size
+    worst = 0.0
+    for obj in reference:
+        if obj['label'] not in labels or obj['score'] < config.DETECTION_CLASS_THRESHOLDS.get(obj['label'], 0):
+            continue
+        differences = [max(abs(a - b) / scale for a, b, scale in zip(obj['bbox'], other['bbox'], (width, height, width, height)))
+                       for other in candidate if other['label'] == obj['label']]
+        worst = max(worst, min(differences, default=1.0))
+    return worst
+
+def validate(filepath, page_numbers, backend, tolerance=config.BACKEND_TOLERANCE):
+    """Runs the fp32 models and the given backend over the pages and checks that table boxes (detection) and
+    column boxes (structure, on the fp32 table crops) stay within tolerance. Returns (passed, worst deviations)."""
+    from columns import get_objects_batch, crop_tables
+    from model_registry import ModelRegistry
+    from rendering import render_page
+    reference, candidate = ModelRegistry(device='cpu', backend='eager'), ModelRegistry(backend=backend)
+    images = [render_page(filepath, page_number) for page_number in page_numbers]
+
+    expected = get_objects_batch(reference.detection, images, config.TABLE_RESIZE)
+    actual = get_objects_batch(candidate.detection, images, config.TABLE_RESIZE)
+    worst = {'detection': max((compare_objects(e, a, image.size, ('table', 'table rotated'))
+                               for e, a, image in zip(expected, actual, images)), default=0.0)}
+
+    crops = [table['image'] for image, objects in zip(images, expected) for table in crop_tables(image, objects)]
+    expected = get_objects_batch(reference.structure, crops, config.CROPPED_RESIZE)
+    actual = get_objects_batch(candidate.structure, crops, config.CROPPED_RESIZE)
+    worst['structure'] = max((compare_objects(e, a, crop.size, ('table column',))
+                              for e, a, crop in zip(expected, actual, crops)), default=0.0)
+    return all(deviation <= tolerance for deviation in worst.values()), worst
+
+if __name__ == '__main__':
+    import utils
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description='Exports the TATR models for faster CPU inference and validates them against fp32')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help=f'Writes the exported models to {config.EXPORTED_MODELS_DIR}')
+    export_parser.add_argument('--backend', nargs='+', choices=list(EXPORTED_SUFFIXES), default=['torchscript'])
+    export_parser.add_argument('--models', nargs='+', choices=['detection', 'structure'], default=['detection', 'structure'])
+    validate_parser = commands.add_parser('validate', help='Compares a backend with the fp32 models on some pages')
+    validate_parser.add_argument('pdf', type=Path)
+    validate_parser.add_argument('--backend', choices=BACKENDS[1:],
+                                 default=config.INFERENCE_BACKEND if config.INFERENCE_BACKEND != 'eager' else 'quantized')
+    validate_parser.add_argument('--pages', type=utils.parse_page_ranges, default=utils.parse_page_ranges('1-8'))
+    validate_parser.add_argument('--tolerance', type=float, default=config.BACKEND_TOLERANCE)
+    args = parser.parse_args()
+
+    if config.TORCH_THREADS:
+        torch.set_num_threads(config.TORCH_THREADS)
+    if args.command == 'export':
+        export(args.models, args.backend)
+    else:
+        import fitz
+        with fitz.open(args.pdf) as document:
+            page_numbers = utils.select_pages(document.page_count, args.pages)
+        passed, worst = validate(args.pdf, page_numbers, args.backend, args.tolerance)
+        for stage, deviation in worst.items():
+            print(f'{stage}: largest box deviation {deviation:.4f} (tolerance {args.tolerance})')
+        print('PASSED' if passed else 'FAILED')
+        sys.exit(0 if passed else 1)
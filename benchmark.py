@@ -0,0 +1,32 @@
+import argparse
+import time
+from pathlib import Path
+
+import config
+from columns import TableInferer, get_objects_batch
+from model_registry import registry
+from rendering import render_page
+
+def benchmark_batch_sizes(filepath, page_numbers, batch_sizes=(1, 2, 4, 8)):
+    images = [TableInferer.preprocess_image(render_page(filepath, page_number))
+              for page_number in page_numbers]
+    registry.warm_up(['detection'])
+    results = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        get_objects_batch(registry.detection, images, config.TABLE_RESIZE, batch_size)
+        elapsed = time.perf_counter() - start
+        results[batch_size] = len(images) / elapsed
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares detection throughput (pages/sec) across batch sizes')
+    parser.add_argument('pdf', type=Path)
+    parser.add_argument('--pages', type=int, default=16)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    results = benchmark_batch_sizes(args.pdf, list(range(1, args.pages + 1)), args.batch_sizes)
+    baseline = results[args.batch_sizes[0]]
+    for batch_size, pages_per_second in results.items():
+        print(f'batch {batch_size:>3}: {pages_per_second:6.2f} pages/sec ({pages_per_second / baseline:.2f}x)')
@@ -0,0 +1,155 @@
+import os
+import csv
+import json
+import shutil
+import argparse
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+import config
+import utils
+import synthetic
+from columns import infer_pages
+from models import Table
+from model_registry import registry
+from instrumentation import metrics
+
+# Synthetic documents of varying size and density: rows/columns per table, share of running text pages
+SCENARIOS = {
+    'small': {'pages': 20, 'rows': 10, 'columns': 4},
+    'dense': {'pages': 20, 'rows': 50, 'columns': 9},
+    'mixed': {'pages': 40, 'rows': 30, 'columns': 6, 'text_pages': 0.5},
+}
+MODES = ('oracle', 'models')
+
+class OracleInferer:
+    """Stands in for TableInferer with the known column edges, so 'oracle' runs measure everything but the models."""
+
+    def __init__(self, page_truth):
+        self.page_truth = page_truth
+
+    def get_columns(self):
+        return [self.page_truth['edges']] if self.page_truth else []
+
+    def get_table_regions(self):
+        return [None] * len(self.get_columns())
+
+def prepare(name, scenario, seed):
+    # Laid out like a real run (relative to the working directory): PDF in the deskewed files, OCR already joined
+    for directory in (config.DESKEWED_FILES_DIR, config.JOINED_OCRED_DIR, config.OUTPUT_TABLES_FILES_DIR):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+    truth = synthetic.make_document(config.JOINED_OCRED_DIR, name, seed=seed, **scenario)
+    shutil.move(Path(config.JOINED_OCRED_DIR) / f'{name}.pdf', Path(config.DESKEWED_FILES_DIR) / f'{name}.pdf')
+    return truth
+
+def extract(name, truth, mode):
+    """Runs get_pages_from_file through Table.save_csv over every page of the document."""
+    filepath = Path(config.DESKEWED_FILES_DIR) / f'{name}.pdf'
+    pages = utils.get_pages_from_file(Path(config.JOINED_OCRED_DIR) / f'{name}.json')
+    for chunk in utils.chunked(pages, config.BATCH_SIZE):
+        page_numbers = [metadata['pageNumber'] for _, metadata in chunk]
+        if mode == 'models':
+            inferers = infer_pages(filepath, page_numbers)
+        else:
+            inferers = {page_number: OracleInferer(truth[page_number - 1]) for page_number in page_numbers}
+        for (page, metadata), page_number in zip(chunk, page_numbers):
+            with metrics.timer('tokens', page_number):
+                tokens = utils.get_tokens_from_words(utils.get_words_from_results(page))
+            table = Table(tokens, metadata, inferer=inferers[page_number])
+            table.save_csv()
+
+def read_table(name, page_number):
+    path = Path(config.OUTPUT_TABLES_FILES_DIR) / f'{name}---{page_number:04}_01.csv'
+    if not path.exists():
+        return None
+    with open(path, encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))[1:]
+
+def get_accuracy(name, truth):
+    """Share of the ground truth cells found with the same text in the same row and column,
+    tables found on table pages and tables extracted from running text pages."""
+    correct = total = found = spurious = 0
+    for page_number, page_truth in enumerate(truth, start=1):
+        table = read_table(name, page_number)
+        if page_truth is None:
+            spurious += table is not None
+            continue
+        found += table is not None
+        for row_index, row in enumerate(page_truth['cells']):
+            for column_index, text in enumerate(row):
+                total += 1
+                try:
+                    correct += table[row_index][column_index] == text
+                except (TypeError, IndexError):
+                    pass
+    table_pages = sum(page_truth is not None for page_truth in truth)
+    return {'cells': correct / total if total else None,
+            'tables_found': f'{found}/{table_pages}',
+            'spurious_tables': spurious}
+
+def get_latencies(timers):
+    # Percentiles over pages of each stage, and of the total time spent on a page
+    per_stage = defaultdict(list)
+    per_page = defaultdict(float)
+    for _, page, stage, seconds, _ in timers:
+        if page is None:
+            continue
+        per_stage[stage].append(seconds)
+        per_page[page] += seconds
+    per_stage['page'] = list(per_page.values())
+    return {stage: {f'p{q}': round(float(np.percentile(values, q)) * 1000, 3) for q in (50, 90, 99)}
+            for stage, values in per_stage.items()}
+
+def run(scenario_names=tuple(SCENARIOS), modes=MODES, seed=0):
+    config.INFERENCE_CACHE = False # Every run has to pay for the models
+    if 'models' in modes:
+        registry.warm_up()
+    results = []
+    for scenario_name in scenario_names:
+        scenario = SCENARIOS[scenario_name]
+        name = f'benchmark_{scenario_name}'
+        truth = prepare(name, scenario, seed)
+        for mode in modes:
+            for path in Path(config.OUTPUT_TABLES_FILES_DIR).glob(f'{name}---*.csv'):
+                path.unlink()
+            metrics.drain()
+            utils.reset_peak_rss()
+            started = time.perf_counter()
+            with metrics.scope(name):
+                extract(name, truth, mode)
+            elapsed = time.perf_counter() - started
+            timers, _ = metrics.drain()
+            results.append({
+                'scenario': scenario_name,
+                'mode': mode,
+                'pages': scenario['pages'],
+                'pages_per_second': round(scenario['pages'] / elapsed, 2),
+                'peak_rss_mb': round(utils.get_peak_rss_mb()),
+                'latency_ms': get_latencies(timers),
+                'accuracy': get_accuracy(name, truth),
+            })
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks table extraction on synthetic PDFs with known tables and fake OCR')
+    parser.add_argument('--workdir', type=Path, default=Path('./.benchmark/'))
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES),
+                        help='oracle: known column edges instead of the models; models: detection and structure recognition')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(args.workdir)
+    results = run(args.scenarios, args.modes, args.seed)
+    for result in results:
+        latency = result['latency_ms']['page']
+        print(f"{result['scenario']:>6} {result['mode']:>6}: {result['pages_per_second']:7.2f} pages/sec, "
+              f"page p50 {latency['p50']:.1f}ms p99 {latency['p99']:.1f}ms, peak RSS {result['peak_rss_mb']} MB, "
+              f"cell accuracy {result['accuracy']['cells']:.3f}, tables {result['accuracy']['tables_found']}, "
+              f"spurious {result['accuracy']['spurious_tables']}")
+    with open('benchmark.json', 'w', encoding='utf-8') as f:
+        f.write(json.dumps(results, indent=1))
@@ -1,20 +1,20 @@
 import torch
 from torchvision import transforms
-from transformers import AutoModelForObjectDetection, TableTransformerForObjectDetection
 
-from PIL import ImageDraw, Image, ImageEnhance
+from PIL import Image, ImageEnhance
 from pathlib import Path
-from functools import lru_cache
-import PyPDF2
-from pdf2image import convert_from_bytes
-import io
+from functools import cached_property
 import config
 import logging
+import time
+from model_registry import registry
+from rendering import render_page
+from frame_pool import get_image, get_view
+from inference_cache import get_cache
+from instrumentation import metrics
 
 logger = logging.getLogger("table_generator")
 
-RED = (255,0,0,200)
-
 class MaxResize(object):
     def __init__(self, max_size):
         self.max_size = max_size
@@ -22,7 +22,8 @@ class MaxResize(object):
     def __call__(self, image):
         scale, x_scale, y_scale = self.get_scale(image)
         resized_image = image.resize((x_scale, y_scale))
-        return resized_image
+        # Pages wrapped from the frame pool are RGBX: the padding byte is dropped on the (smaller) resized image
+        return resized_image if resized_image.mode == 'RGB' else resized_image.convert('RGB')
     
     def get_scale(self, image):
         width, height = image.size
@@ -31,43 +32,198 @@ class MaxResize(object):
         x_scale, y_scale = int(round(scale * width)), int(round(scale * height))
         return scale, x_scale, y_scale
 
+def box_cxcywh_to_xyxy(x):
+    x_c, y_c, w, h = x.unbind(-1)
+    b = [(x_c - 0.5 * w), (y_c - 0.5 * h), (x_c + 0.5 * w), (y_c + 0.5 * h)]
+    return torch.stack(b, dim=1)
+
+def rescale_bboxes(out_bbox, size):
+    img_w, img_h = size
+    b = box_cxcywh_to_xyxy(out_bbox)
+    b = b * torch.tensor([img_w, img_h, img_w, img_h], dtype=torch.float32)
+    return b
+
+def outputs_to_objects(outputs, img_size, id2label, index=0):
+    m = outputs.logits.softmax(-1).max(-1)
+    pred_labels = list(m.indices.detach().cpu().numpy())[index]
+    pred_scores = list(m.values.detach().cpu().numpy())[index]
+    pred_bboxes = outputs['pred_boxes'].detach().cpu()[index]
+    pred_bboxes = [elem.tolist() for elem in rescale_bboxes(pred_bboxes, img_size)]
+
+    objects = []
+    for label, score, bbox in zip(pred_labels, pred_scores, pred_bboxes):
+        class_label = id2label[int(label)]
+        if not class_label == 'no object':
+            objects.append({'label': class_label, 'score': float(score),
+                            'bbox': [float(elem) for elem in bbox]})
+    return objects
+
+def pad_and_mask(tensors):
+    # DETR expects a single (B, 3, H, W) batch: smaller images are padded bottom/right
+    # and the pixel mask tells the model which pixels are real
+    max_height = max(tensor.shape[1] for tensor in tensors)
+    max_width = max(tensor.shape[2] for tensor in tensors)
+    pixel_values = torch.zeros((len(tensors), 3, max_height, max_width), dtype=tensors[0].dtype)
+    pixel_mask = torch.zeros((len(tensors), max_height, max_width), dtype=torch.long)
+    for index, tensor in enumerate(tensors):
+        _, height, width = tensor.shape
+        pixel_values[index, :, :height, :width] = tensor
+        pixel_mask[index, :height, :width] = 1
+    return pixel_values, pixel_mask
+
+def get_objects_batch(model, images, resize, batch_size=config.BATCH_SIZE):
+    """Runs the model over images of any size, batch_size at a time, returning one object list per image."""
+    detection_transform = transforms.Compose([
+        MaxResize(resize),
+        transforms.ToTensor(),
+        transforms.Normalize(*config.NORMALIZE_VECTORS)])
+    id2label = {**model.config.id2label}
+    id2label[len(id2label)] = "no object"
+    results = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        pixel_values, pixel_mask = pad_and_mask([detection_transform(image) for image in batch])
+        with torch.no_grad():
+            outputs = model(pixel_values=pixel_values.to(registry.device), pixel_mask=pixel_mask.to(registry.device))
+        for index, image in enumerate(batch):
+            results.append(outputs_to_objects(outputs, image.size, id2label, index))
+    return results
+
+def box_iou(box_a, box_b):
+    x1, y1 = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    x2, y2 = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0
+
+def deduplicate_objects(objects, iou_threshold=config.TABLE_IOU_THRESHOLD):
+    # The detector sometimes outputs the same table more than once: keeps the best scored box of each overlapping group
+    kept = []
+    for obj in sorted(objects, key=lambda obj: obj['score'], reverse=True):
+        if all(box_iou(obj['bbox'], other['bbox']) < iou_threshold for other in kept):
+            kept.append(obj)
+    return sorted(kept, key=lambda obj: (obj['bbox'][1], obj['bbox'][0]))
+
+def crop_tables(image, objects):
+    return objects_to_crops(img=image, tokens=[], objects=deduplicate_objects(objects),
+                            class_thresholds=config.DETECTION_CLASS_THRESHOLDS, padding=config.CROP_PADDING)
+
+def get_page_image(filepath, page_number, frame=None):
+    # Pages already rendered by a render worker are read in place from the frame pool
+    return get_image(frame) if frame else render_page(filepath, page_number)
+
+def infer_pages(filepath, page_numbers, batch_size=config.BATCH_SIZE, frames=None):
+    """Runs the pipeline stages over the pages in batches: detection on the page images, then one
+    structure recognition pass over the deduplicated table crops of all pages in the batch.
+    Pages whose render is already in the inference cache skip both models. frames maps page numbers
+    to their Frame in the frame pool (see frame_pool.py); the other pages are rendered here."""
+    cache = get_cache()
+    frames = frames or {}
+    inferers = {}
+    for start in range(0, len(page_numbers), batch_size):
+        batch = page_numbers[start:start + batch_size]
+        pages = [get_page_image(filepath, page_number, frames.get(page_number)) for page_number in batch]
+        images = [TableInferer.preprocess_image(page) for page in pages]
+        # Pages from the frame pool are hashed straight from their slot, without copying them out
+        keys = [cache.get_key(image, get_view(frames[page_number]) if frames.get(page_number) and image is page else None)
+                for image, page, page_number in zip(images, pages, batch)] if cache else [None] * len(batch)
+        cached = [cache.get(key) for key in keys] if cache else [None] * len(batch)
+        missing = [index for index, entry in enumerate(cached) if entry is None]
+
+        started = time.perf_counter()
+        detections = get_objects_batch(registry.detection, [images[index] for index in missing], config.TABLE_RESIZE, batch_size) if missing else []
+        detection_time = (time.perf_counter() - started) / max(len(missing), 1)
+        detections = dict(zip(missing, detections))
+
+        objects = [entry['objects'] if entry else detections[index] for index, entry in enumerate(cached)]
+        tables = [crop_tables(image, page_objects) for image, page_objects in zip(images, objects)]
+        crops = [table['image'] for index in missing for table in tables[index]]
+
+        started = time.perf_counter()
+        new_cells = get_objects_batch(registry.structure, crops, config.CROPPED_RESIZE, batch_size) if crops else []
+        structure_time = (time.perf_counter() - started) / max(len(crops), 1)
+
+        cells = [entry['cells'] if entry else None for entry in cached]
+        for index in missing:
+            cells[index], new_cells = new_cells[:len(tables[index])], new_cells[len(tables[index]):]
+            if cache:
+                cache.put(keys[index], {'objects': objects[index], 'cells': cells[index]})
+
+        for index, page_number in enumerate(batch):
+            timings = {} if cached[index] else {'detection': detection_time, 'structure': structure_time * len(tables[index])}
+            inferers[page_number] = TableInferer(
+                filepath, page_number, image=images[index], objects=objects[index], tables=tables[index],
+                cells=cells[index], timings=timings)
+            inferers[page_number].log_stages(cells[index])
+    return inferers
+
+def objects_to_crops(img, tokens, objects, class_thresholds, padding):
+    table_crops = []
+    for obj in objects:
+        if obj['score'] < class_thresholds[obj['label']]:
+            continue
+
+        cropped_table = {}
+
+        bbox = obj['bbox']
+        bbox = [bbox[0]-padding, bbox[1]-padding, bbox[2]+padding, bbox[3]+padding]
+
+        cropped_img = img.crop(bbox)
+
+        table_tokens = [token for token in tokens if token['score'] >= config.SCORE_THRESHOLD]
+        for token in table_tokens:
+            token['bbox'] = [token['bbox'][0]-bbox[0],
+                            token['bbox'][1]-bbox[1],
+                            token['bbox'][2]-bbox[0],
+                            token['bbox'][3]-bbox[1]]
+
+        # If table is predicted to be rotated, rotate cropped image and tokens/words:
+        if obj['label'] == 'table rotated':
+            cropped_img = cropped_img.rotate(270, expand=True)
+            for token in table_tokens:
+                bbox = token['bbox']
+                bbox = [cropped_img.size[0]-bbox[3]-1,
+                        bbox[0],
+                        cropped_img.size[0]-bbox[1]-1,
+                        bbox[2]]
+                token['bbox'] = bbox
+        cropped_table['image'] = cropped_img
+        cropped_table['tokens'] = table_tokens
+        cropped_table['object'] = obj
+        cropped_table['rotated'] = obj['label'] == 'table rotated'
+
+        table_crops.append(cropped_table)
+
+    return table_crops
+
 class TableInferer:
     
-    def __init__(self, filepath, page_number):
+    def __init__(self, filepath, page_number, image=None, objects=None, tables=None, cells=None, timings=None):
         self.filepath = Path(filepath)
         self.page_number = page_number
-        self.image = self.get_page_as_image().convert("RGB")
-        self.rotated = False
-        self.get_cells()
-        self.draw_grid()
+        self.timings = timings or {}
+        # Every stage (render, detection, structure, grid) runs on first access. Stages already computed
+        # elsewhere (e.g. in batch by infer_pages) are injected instead of recomputed
+        for name, value in [('image', image), ('objects', objects), ('tables', tables), ('cells', cells)]:
+            if value is not None:
+                setattr(self, name, value)
         
     def get_page_as_image(self):
-        reader = PyPDF2.PdfReader(self.filepath)
-        writer = PyPDF2.PdfWriter()
-        page = reader.pages[self.page_number - 1]
-        writer.add_page(page)
-        buf = io.BytesIO()
-        writer.write(buf)
-        buf.seek(0)
-        image = convert_from_bytes(buf.read())
-        return image[0]
-
-    def preprocess_image(self, image):
-        ... # Preprocessing function, if needed (e.g. change contrast)
+        return render_page(self.filepath, self.page_number)
+
+    @cached_property
+    def image(self):
+        started = time.perf_counter()
+        image = self.preprocess_image(self.get_page_as_image())
+        self.timings['render'] = time.perf_counter() - started
         return image
 
-    def draw_grid(self):
-        image = self.image.copy()
-        draw = ImageDraw.Draw(image, 'RGBA')
-        if getattr(self, 'table_corners', None):
-            for column_pack, corner_set in zip(self.get_columns(), self.table_corners):
-                draw.rectangle(corner_set, outline="red", width=5)
-                for column in column_pack:
-                    draw.line(
-                        [(column * image.width, corner_set[1]), (column * image.width, corner_set[3])], 
-                        fill=RED, 
-                        width=3)
-            image.save(Path(config.DEBUG_GRID_FILES_DIR) / f"{self.filepath.with_suffix('').name}_{self.page_number:04}.jpg")
+    @staticmethod
+    def preprocess_image(image):
+        ... # Preprocessing function, if needed (e.g. change contrast)
+        return image
 
     def get_table_scale(self):
         return MaxResize(max_size=config.TABLE_RESIZE).get_scale(self.image)
@@ -75,119 +231,72 @@ class TableInferer:
     def get_cropped_scale(self):
         return MaxResize(max_size=config.CROPPED_RESIZE).get_scale(self.cropped_table)
 
-    @lru_cache
-    def get_cells(self):
-        
-        self.table_corners = []
-        self.cropped_table = []
-        self.cropped_size = []
-        
-        self.image = self.preprocess_image(self.image)
-        objects = self.get_objects(model=AutoModelForObjectDetection.from_pretrained("microsoft/table-transformer-detection", revision="no_timm"), 
+    @cached_property
+    def objects(self):
+        started = time.perf_counter()
+        objects = self.get_objects(model=registry.detection, 
                                    image=self.image, 
                                    resize=config.TABLE_RESIZE)
-        cell_pack = []
-        for obj in objects:
-            self.table_corners.append(obj['bbox'])
-            tokens = []
-            table_crops = self.objects_to_crops(img=self.image, tokens=tokens, objects=objects, 
-                                                class_thresholds=config.DETECTION_CLASS_THRESHOLDS, padding=config.CROP_PADDING)
-            for table in table_crops:
-                cropped_table = table['image'].convert("RGB")
-                self.cropped_table.append(table['image'].convert("RGB"))
-                self.cropped_size.append(self.cropped_table[-1].size)
-                cells = self.get_objects(model= TableTransformerForObjectDetection.from_pretrained("microsoft/table-structure-recognition-v1.1-all"), 
-                                    image= cropped_table, 
-                                    resize= config.CROPPED_RESIZE)
-                if cells not in cell_pack: 
-                    cell_pack.append(cells)
-        if not cell_pack: 
-            logger.warn(f'Could not extract table from file {self.filepath.name} - page {self.page_number}')
-
-        return cell_pack
-    
-    def get_objects(self, model, image, resize):
-        model.to(self.device)
-        detection_transform = transforms.Compose([
-            MaxResize(resize),
-            transforms.ToTensor(),
-            transforms.Normalize(*config.NORMALIZE_VECTORS)])
-        pixel_values = detection_transform(image).unsqueeze(0)
-        pixel_values = pixel_values.to(self.device)
-        with torch.no_grad():
-          outputs = model(pixel_values)
-        id2label = model.config.id2label
-        id2label[len(model.config.id2label)] = "no object"
-        objects = self.outputs_to_objects(outputs, image.size, id2label)
+        self.timings['detection'] = time.perf_counter() - started
         return objects
-    
+
+    @cached_property
+    def tables(self):
+        return crop_tables(self.image, self.objects)
+
     @property
-    def device(self):
-        return "cuda" if torch.cuda.is_available() else "cpu"
-    
-    def box_cxcywh_to_xyxy(self, x):
-        x_c, y_c, w, h = x.unbind(-1)
-        b = [(x_c - 0.5 * w), (y_c - 0.5 * h), (x_c + 0.5 * w), (y_c + 0.5 * h)]
-        return torch.stack(b, dim=1)
-
-    def rescale_bboxes(self, out_bbox, size):
-        img_w, img_h = size
-        b = self.box_cxcywh_to_xyxy(out_bbox)
-        b = b * torch.tensor([img_w, img_h, img_w, img_h], dtype=torch.float32)
-        return b
-
-    def outputs_to_objects(self, outputs, img_size, id2label):
-        m = outputs.logits.softmax(-1).max(-1)
-        pred_labels = list(m.indices.detach().cpu().numpy())[0]
-        pred_scores = list(m.values.detach().cpu().numpy())[0]
-        pred_bboxes = outputs['pred_boxes'].detach().cpu()[0]
-        pred_bboxes = [elem.tolist() for elem in self.rescale_bboxes(pred_bboxes, img_size)]
-
-        objects = []
-        for label, score, bbox in zip(pred_labels, pred_scores, pred_bboxes):
-            class_label = id2label[int(label)]
-            if not class_label == 'no object':
-                objects.append({'label': class_label, 'score': float(score),
-                                'bbox': [float(elem) for elem in bbox]})
-        return objects
+    def table_corners(self):
+        return [table['object']['bbox'] for table in self.tables]
 
-    def objects_to_crops(self, img, tokens, objects, class_thresholds, padding):
-        table_crops = []
-        for obj in objects:
-            if obj['score'] < class_thresholds[obj['label']]:
-                continue
+    def get_table_regions(self):
+        # Table bboxes (image pixels, y growing downwards) in token coordinates: normalized (left, top, right, bottom), top = 1 - y
+        width, height = self.image.size
+        return [(x0 / width, 1 - y0 / height, x1 / width, 1 - y1 / height) for x0, y0, x1, y1 in self.table_corners]
 
-            cropped_table = {}
+    @property
+    def cropped_table(self):
+        return [table['image'] for table in self.tables]
 
-            bbox = obj['bbox']
-            bbox = [bbox[0]-padding, bbox[1]-padding, bbox[2]+padding, bbox[3]+padding]
+    @property
+    def cropped_size(self):
+        return [image.size for image in self.cropped_table]
 
-            cropped_img = img.crop(bbox)
+    @property
+    def rotated(self):
+        return any(table['rotated'] for table in self.tables)
 
-            table_tokens = [token for token in tokens if token['score'] >= config.SCORE_THRESHOLD]
-            for token in table_tokens:
-                token['bbox'] = [token['bbox'][0]-bbox[0],
-                                token['bbox'][1]-bbox[1],
-                                token['bbox'][2]-bbox[0],
-                                token['bbox'][3]-bbox[1]]
-
-            # If table is predicted to be rotated, rotate cropped image and tokens/words:
-            if obj['label'] == 'table rotated':
-                cropped_img = cropped_img.rotate(270, expand=True)
-                for token in table_tokens:
-                    bbox = token['bbox']
-                    bbox = [cropped_img.size[0]-bbox[3]-1,
-                            bbox[0],
-                            cropped_img.size[0]-bbox[1]-1,
-                            bbox[2]]
-                    token['bbox'] = bbox
-                self.rotated = True
-            cropped_table['image'] = cropped_img
-            cropped_table['tokens'] = table_tokens
-
-            table_crops.append(cropped_table)
-
-        return table_crops
+    def get_cells(self):
+        return self.cells
+
+    @cached_property
+    def cells(self):
+        started = time.perf_counter()
+        cell_pack = get_objects_batch(registry.structure, self.cropped_table, config.CROPPED_RESIZE) if self.tables else []
+        self.timings['structure'] = time.perf_counter() - started
+        self.log_stages(cell_pack)
+        return cell_pack
+
+    def log_stages(self, cells):
+        if not cells: 
+            logger.warning(f'Could not extract table from file {self.filepath.name} - page {self.page_number}')
+        timings = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in self.timings.items()) or 'cached'
+        logger.info(f'{self.filepath.name} - page {self.page_number:04}: {len(self.objects)} objects, '
+                    f'{len(self.tables)} tables, {sum(len(pack) for pack in cells)} cells ({timings})')
+        # Render time is recorded by the renderer itself
+        for stage in ('detection', 'structure'):
+            if stage in self.timings:
+                metrics.add(stage, self.timings[stage], self.page_number)
+        if 'detection' not in self.timings:
+            metrics.count('inference_cache_hits', 1, self.page_number)
+        metrics.count('tables', len(self.tables), self.page_number)
+        metrics.count('cells', sum(len(pack) for pack in cells), self.page_number)
+    
+    def get_objects(self, model, image, resize):
+        return get_objects_batch(model, [image], resize, batch_size=1)[0]
+    
+    @property
+    def device(self):
+        return registry.device
 
     def filter_close_values(self, values):
         filtered_values = [values[0]] if values else []
@@ -196,8 +305,11 @@ class TableInferer:
                 filtered_values.append(values[i])
         return filtered_values
 
-    @lru_cache
     def get_features(self):
+        return self.features
+
+    @cached_property
+    def features(self):
         edges = []
         bbox_index = 3 if self.rotated else 2
         feature_name = 'table row' if self.rotated else 'table column'
@@ -210,8 +322,11 @@ class TableInferer:
             edges_pack.append(edges)
         return edges_pack
 
-    @lru_cache
     def get_columns(self):
+        return self.columns
+
+    @cached_property
+    def columns(self):
         columns_pack = []
         for index, lines in enumerate(self.get_features()):
             # for lines in pack:
@@ -4,29 +4,94 @@ ORIGINAL_FILES_DIR = './01_original_files/'  # Arquivos originais <--- INSERIR P
 DESKEWED_FILES_DIR = './02_deskewed_files/' # Arquivos desinclinados
 OCRED_PAGES_DIR = './03_ocred_pages_files/' # Arquivos com texto extraído pelo Google Vision
 JOINED_OCRED_DIR = './04_joined_ocred_files/' # Arquivos resultados do OCR consolidados em um único arquivo
-DEBUG_GRID_FILES_DIR = './05_debug_grid_files/' # Arquivos com grids desenhados
+DEBUG_GRID_FILES_DIR = './05_debug_grid_files/' # Um PDF por documento com palavras, tabelas, colunas e células desenhadas
 OUTPUT_TABLES_FILES_DIR = './06_output_table_files/' #Arquivos com tabelas extraídas ---> RESULTADO FINAL
 
+EXPORT_JOINED_JSON = True # Além do índice binário (.ocr), exporta o resultado consolidado em JSON
+OUTPUT_FORMATS = ('csv',) # 'csv' (um arquivo por tabela e página) e/ou 'parquet' (um arquivo por documento, requer pyarrow)
+PARQUET_ROW_GROUP_SIZE = 100_000 # Células por row group do Parquet
+
 #OPERATIONS
-DESKEW=False
-OCR=False
-JOIN=False
-GRID=False
+# Etapas desligadas não são executadas: usam o que já estiver nas pastas (sem desinclinação, o PDF original é copiado)
+DESKEW=True
+OCR=True
+JOIN=True
+GRID=False # Desenha as anotações de depuração em 05_debug_grid_files
+PIPELINE_STATE_DIR = './.pipeline_state/' # Impressões digitais das etapas já executadas, por documento e por página
+
+#DESKEW
+DESKEW_DPI = 100 # Resolução usada para estimar a inclinação (e das páginas corrigidas)
+DESKEW_MAX_ANGLE = 5 # graus
+DESKEW_ANGLE_STEP = 0.1 # graus
+DESKEW_ANGLE_THRESHOLD = 0.3 # Páginas menos inclinadas que isso são copiadas sem alteração
+
+#INSTRUMENTATION
+METRICS_DIR = './metrics/' # Tempos e contadores por etapa, documento e página (metrics.json / metrics.csv) e perfis
+PROFILE_PAGES = None # Ex.: '10-12' perfila a extração dessas páginas (mesmo formato de --pages)
+PROFILER = 'cprofile' # 'cprofile' ou 'torch' (torch.profiler, gera um trace do Chrome)
+
+#PARALLELISM
+WORKERS = 1 # Processos gerando tabelas em paralelo (cada um carrega seus próprios modelos)
 
 #ROW DETECTION
 GAP_BETWEEN_LINES = 0.007
 
+#MODELS
+DETECTION_MODEL = "microsoft/table-transformer-detection"
+DETECTION_MODEL_REVISION = "no_timm"
+STRUCTURE_MODEL = "microsoft/table-structure-recognition-v1.1-all"
+STRUCTURE_MODEL_REVISION = "main"
+
+#CPU INFERENCE
+INFERENCE_BACKEND = 'eager' # 'eager' (fp32), 'quantized' (int8 dinâmico), 'torchscript' ou 'onnx' (exportar antes com accelerated.py)
+EXPORTED_MODELS_DIR = './.models/' # Modelos exportados para TorchScript / ONNX
+BACKEND_TOLERANCE = 0.02 # Diferença máxima das caixas (fração do tamanho da imagem) em relação ao fp32 na validação
+TORCH_THREADS = None # Threads de inferência por processo; se None, os núcleos são divididos entre os workers
+
+#RENDERING
+RENDER_DPI = None # Se None, a resolução é derivada de TABLE_RESIZE
+RENDER_OVERSAMPLE = 2 # Lado maior da página renderizada = TABLE_RESIZE * RENDER_OVERSAMPLE
+RENDER_WORKERS = 0 # Com WORKERS > 1, processos que renderizam as páginas adiantado em memória compartilhada; 0 = cada worker renderiza as suas
+FRAME_POOL_SLOTS = None # Páginas renderizadas mantidas em memória compartilhada; se None, o suficiente para os lotes em andamento
+
 #COLUMN DETECTION
 TABLE_RESIZE = 800
 CROPPED_RESIZE = 1000
 CROP_PADDING = 0
+BATCH_SIZE = 4 # Páginas (ou recortes de tabela) por passada do modelo
 NORMALIZE_VECTORS = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 DETECTION_CLASS_THRESHOLDS = {
     "table": 0.5,
     "table rotated": 0.5,
     "no object": 10
 }
+TABLE_IOU_THRESHOLD = 0.9 # Tabelas detectadas com sobreposição maior que isso são consideradas a mesma
 SIMILARITY_THRESHOLD = 7
 SCORE_THRESHOLD = 0.7
+TABLE_REGION_PADDING = 0.005 # Margem (fração da página) em volta de cada tabela detectada ao recortar os tokens dela
+SPATIAL_CELL_SIZE = 0.05 # Lado (fração da página) das células do índice espacial dos tokens
+
+#PREFILTER
+PREFILTER = False # Páginas que não parecem ter tabelas (pela geometria do OCR) não passam pelos modelos; ligar só depois de escolher PREFILTER_THRESHOLD com 'python prefilter.py'
+PREFILTER_THRESHOLD = 0.2 # Nota mínima (0 a 1) para a página ir para a detecção
+PREFILTER_MIN_GAP = 0.02 # Espaço horizontal (fração da largura) que separa duas células de uma mesma linha
+PREFILTER_ALIGN_TOLERANCE = 0.01 # Diferença máxima entre bordas/centros de células alinhadas
+PREFILTER_MIN_ALIGNED_ROWS = 3 # Linhas que precisam compartilhar um alinhamento para formar uma coluna
+PREFILTER_WEIGHTS = {'alignment': 0.4, 'regularity': 0.3, 'numeric': 0.3}
+
+#INFERENCE CACHE
+INFERENCE_CACHE = True # Reaproveita detecções de páginas já processadas (mesma renderização, mesmos modelos)
+INFERENCE_CACHE_DIR = './.inference_cache/'
+INFERENCE_CACHE_MAX_BYTES = 512 * 2**20
+
+BUCKET_NAME='tcc-caio-donalisio-93'
 
-BUCKET_NAME='tcc-caio-donalisio-93'
\ No newline at end of file
+#OCR
+OCR_ENGINE = 'vision' # 'vision' (Google Cloud Vision) ou 'local' (EasyOCR, apenas nas tabelas detectadas)
+OCR_BATCH_SIZE = 100 # Páginas por arquivo de resultado
+LOCAL_OCR_LANGUAGES = ['pt', 'en']
+OCR_CONCURRENCY = 4 # Documentos enviados ao Google Vision ao mesmo tempo
+OCR_RETRIES = 3
+OCR_POLL_INTERVAL = 10 # segundos
+OCR_TIMEOUT = 1800 # segundos, por documento
+OCR_STATE_PATH = './.pipeline_state/ocr/requests.json' # Envios em andamento, para retomar execuções interrompidas
\ No newline at end of file
@@ -0,0 +1,77 @@
+import math
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import fitz
+import numpy as np
+from PIL import Image
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+def estimate_skew(image: Image.Image, max_angle=config.DESKEW_MAX_ANGLE, step=config.DESKEW_ANGLE_STEP):
+    """Estimates the skew (degrees) of a page image: text lines are horizontal when the row profile
+    of the dark pixels is at its sharpest, so the angle maximizing the variance of that profile wins."""
+    grey = np.asarray(image.convert('L'), dtype=np.float32)
+    ys, xs = np.nonzero(grey < 128)
+    if len(xs) < 100:
+        return 0.0
+    xs = xs - grey.shape[1] / 2
+    best_angle, best_score = 0.0, -1
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        # Row each dark pixel falls into once the page is rotated by angle (small angle shear)
+        rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        score = np.var(profile)
+        if score > best_score:
+            best_angle, best_score = round(float(angle), 3), score
+    return best_angle
+
+def deskew_page(filepath, page_number, dpi=config.DESKEW_DPI):
+    """Returns (page_number, angle). The angle is only estimated at dpi, the page itself is never rasterized."""
+    with fitz.open(filepath) as document:
+        page = document[page_number - 1]
+        pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    image = Image.frombuffer("RGB", (pixmap.width, pixmap.height), pixmap.samples, "raw", "RGB", pixmap.stride, 1)
+    return page_number, estimate_skew(image)
+
+def get_rotated_rect(rect, angle):
+    # Where the source page has to be shown so that, once rotated, it keeps its original scale:
+    # the bounding box of the rotated page, centered on the page (what falls outside is clipped)
+    cos, sin = abs(math.cos(math.radians(angle))), abs(math.sin(math.radians(angle)))
+    width, height = rect.width * cos + rect.height * sin, rect.width * sin + rect.height * cos
+    center = (rect.tl + rect.br) / 2
+    return fitz.Rect(center.x - width / 2, center.y - height / 2, center.x + width / 2, center.y + height / 2)
+
+def deskew_file(filepath, output_path, workers=config.WORKERS):
+    """Writes a copy of the PDF where every page skewed by more than DESKEW_ANGLE_THRESHOLD is replaced by a page
+    of the same size showing the original one rotated, so its content (vector or scanned image) keeps its resolution;
+    pages under the threshold are copied untouched."""
+    filepath, output_path = Path(filepath), Path(output_path)
+    with fitz.open(filepath) as document:
+        page_count = document.page_count
+    page_numbers = range(1, page_count + 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(deskew_page, [filepath] * page_count, page_numbers, chunksize=4))
+    else:
+        results = [deskew_page(filepath, page_number) for page_number in page_numbers]
+
+    with fitz.open(filepath) as source, fitz.open() as output:
+        for page_number, angle in results:
+            if abs(angle) < config.DESKEW_ANGLE_THRESHOLD:
+                output.insert_pdf(source, from_page=page_number - 1, to_page=page_number - 1)
+                continue
+            rect = source[page_number - 1].rect
+            page = output.new_page(width=rect.width, height=rect.height)
+            # The estimated angle is the rotation that levels the text lines
+            page.show_pdf_page(get_rotated_rect(page.rect, angle), source, page_number - 1, rotate=angle)
+        tmp_path = output_path.with_suffix('.tmp')
+        output.save(tmp_path, garbage=3, deflate=True)
+    tmp_path.replace(output_path)
+    straightened = [(page_number, angle) for page_number, angle in results if abs(angle) >= config.DESKEW_ANGLE_THRESHOLD]
+    logger.info(f'Deskewed {filepath.name}: {len(straightened)} of {page_count} pages straightened')
+    return straightened
@@ -0,0 +1,94 @@
+import logging
+from collections import deque, namedtuple
+from functools import lru_cache
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import config
+from rendering import get_renderer
+from instrumentation import metrics
+
+logger = logging.getLogger("table_generator")
+
+# Where a rendered page is: shared memory block, byte offset of its slot and page size in pixels
+Frame = namedtuple('Frame', ['pool', 'offset', 'width', 'height'])
+
+# Pixels are kept as RGBX (4 bytes), the layout PIL uses for RGB, so images can wrap a slot without copying it
+CHANNELS = 4
+
+def get_slot_bytes():
+    # Largest page the renderer produces: TABLE_RESIZE * RENDER_OVERSAMPLE on the longer side or,
+    # at a fixed RENDER_DPI, a 17 inch (tabloid) side. Larger pages are rendered by the extraction worker itself
+    side = config.RENDER_DPI * 17 if config.RENDER_DPI else config.TABLE_RESIZE * config.RENDER_OVERSAMPLE
+    return (side + 1) ** 2 * CHANNELS
+
+class FramePool:
+    """Page images shared between the render workers and the extraction workers: a fixed number of slots in a single
+    shared memory block, each big enough for one rendered page. The main process owns the block and hands out the slots;
+    a render worker writes the page into its slot and the extraction worker reads it in place, until the chunk is
+    collected and its slots are released for the next ones."""
+
+    def __init__(self, slots, slot_bytes=None):
+        self.slot_bytes = slot_bytes or get_slot_bytes()
+        self.memory = shared_memory.SharedMemory(create=True, size=slots * self.slot_bytes)
+        self.free = deque(range(slots))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def acquire(self, count):
+        # Up to count slots; pages left without one are rendered by the extraction worker
+        return [self.free.popleft() for _ in range(min(count, len(self.free)))]
+
+    def release(self, slots):
+        self.free.extend(slots)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+@lru_cache(maxsize=None)
+def attach(name):
+    # Kept open for the life of the worker: images handed out by get_image point into the block
+    return shared_memory.SharedMemory(name=name)
+
+def write_frame(memory, name, offset, slot_bytes, pixmap):
+    """Copies the RGB samples of a pixmap into a slot. Returns the Frame (None if the page doesn't fit) and the bytes copied."""
+    width, height = pixmap.width, pixmap.height
+    if width * height * CHANNELS > slot_bytes:
+        return None, 0
+    samples = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(height, pixmap.stride)[:, :width * 3]
+    view = np.ndarray((height, width, CHANNELS), dtype=np.uint8, buffer=memory.buf, offset=offset)
+    view[..., :3] = samples.reshape(height, width, 3)
+    # The padding byte is part of what the inference cache hashes, so it can't keep what the slot held before
+    view[..., 3] = 255
+    return Frame(name, offset, width, height), samples.size
+
+def get_view(frame):
+    memory = attach(frame.pool)
+    return np.ndarray((frame.height, frame.width, CHANNELS), dtype=np.uint8, buffer=memory.buf, offset=frame.offset)
+
+def get_image(frame):
+    # PIL maps RGBX buffers instead of copying them: the first copy of the page is the model's resize (or a table crop)
+    return Image.frombuffer('RGBX', (frame.width, frame.height), get_view(frame), 'raw', 'RGBX', 0, 1)
+
+def render_frames(filepath, name, slot_bytes, slots, page_numbers):
+    """Render worker: renders the first len(slots) pages into the given slots. Returns one Frame per page
+    (None for pages without a slot, that don't fit in one or that failed, which the extraction worker renders
+    itself) and the metrics recorded meanwhile."""
+    memory = attach(name)
+    renderer = get_renderer(Path(filepath))
+    frames = [None] * len(page_numbers)
+    with metrics.scope(Path(filepath).name):
+        for index, (slot, page_number) in enumerate(zip(slots, page_numbers)):
+            try:
+                pixmap = renderer.get_pixmap(page_number)
+                frames[index], copied = write_frame(memory, name, slot * slot_bytes, slot_bytes, pixmap)
+                metrics.count('bytes_copied', copied, page_number)
+            except Exception as e:
+                logger.warning(f'Could not render page {page_number:04} into the frame pool: {e!r}')
+    return frames, metrics.drain()
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+def get_fingerprint():
+    # Everything besides the page pixels that changes what the models output for a page.
+    # Post-processing settings (GAP_BETWEEN_LINES, SIMILARITY_THRESHOLD...) are left out on purpose.
+    # The backend only goes in when it isn't fp32, so entries cached before it existed stay valid
+    backend = {'backend': config.INFERENCE_BACKEND} if config.INFERENCE_BACKEND != 'eager' else {}
+    return json.dumps({
+        **backend,
+        'detection': [config.DETECTION_MODEL, config.DETECTION_MODEL_REVISION],
+        'structure': [config.STRUCTURE_MODEL, config.STRUCTURE_MODEL_REVISION],
+        'table_resize': config.TABLE_RESIZE,
+        'cropped_resize': config.CROPPED_RESIZE,
+        'normalize': config.NORMALIZE_VECTORS,
+        'crop_padding': config.CROP_PADDING,
+        'class_thresholds': config.DETECTION_CLASS_THRESHOLDS,
+        'iou_threshold': config.TABLE_IOU_THRESHOLD,
+    }, sort_keys=True)
+
+class InferenceCache:
+    """On-disk cache of the detected objects and cells of a page, keyed by the hash of its render."""
+
+    def __init__(self, directory=config.INFERENCE_CACHE_DIR, max_bytes=config.INFERENCE_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.fingerprint = get_fingerprint().encode('utf-8')
+        self.size = sum(path.stat().st_size for path in self._entries())
+
+    def _entries(self):
+        return self.directory.glob('*/*.json')
+
+    def _path(self, key):
+        return self.directory / key[:2] / f'{key}.json'
+
+    def get_key(self, image, pixels=None):
+        # RGB pages are hashed in the RGBX layout of the frame pool (padding byte 255), so a page read in place
+        # from its slot (pixels, a buffer of those bytes) gets the same key as its in-process RGB render
+        digest = hashlib.blake2b(self.fingerprint, digest_size=20)
+        mode = 'RGB' if image.mode == 'RGBX' else image.mode
+        digest.update(f'{mode}{image.size}'.encode('utf-8'))
+        if pixels is not None:
+            digest.update(pixels)
+        else:
+            digest.update(image.tobytes('raw', 'RGBX') if mode == 'RGB' else image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = json.loads(f.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Access time is tracked through mtime, so eviction is least recently used first
+        path.touch()
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(value))
+        tmp_path.replace(path)
+        self.size += path.stat().st_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Rescanned from disk since other workers share the directory; trims down to 90% to avoid evicting on every put
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= size
+            evicted += 1
+        logger.info(f'Inference cache: evicted {evicted} entries ({self.size / 2**20:.1f} MB left)')
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None and config.INFERENCE_CACHE:
+        _cache = InferenceCache()
+    return _cache
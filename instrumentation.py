@@ -0,0 +1,130 @@
+import csv
+import json
+import time
+import cProfile
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+class Metrics:
+    """Timers and counters per (document, page, stage). Pool workers collect their own and
+    ship them back with each chunk's results (drain/merge), so the main process holds the whole run."""
+
+    def __init__(self):
+        self.document = None
+        self.timers = defaultdict(lambda: [0.0, 0]) # (document, page, stage) -> [seconds, calls]
+        self.counters = defaultdict(int) # (document, page, name) -> value
+
+    @contextmanager
+    def scope(self, document):
+        # Everything recorded inside the block is attributed to this document
+        previous, self.document = self.document, document
+        try:
+            yield
+        finally:
+            self.document = previous
+
+    @contextmanager
+    def timer(self, stage, page=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started, page)
+
+    def add(self, stage, seconds, page=None, calls=1):
+        entry = self.timers[(self.document, page, stage)]
+        entry[0] += seconds
+        entry[1] += calls
+
+    def count(self, name, value=1, page=None):
+        self.counters[(self.document, page, name)] += value
+
+    def drain(self):
+        snapshot = ([[*key, *value] for key, value in self.timers.items()],
+                    [[*key, value] for key, value in self.counters.items()])
+        self.timers.clear()
+        self.counters.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        timers, counters = snapshot
+        for document, page, stage, seconds, calls in timers:
+            entry = self.timers[(document, page, stage)]
+            entry[0] += seconds
+            entry[1] += calls
+        for document, page, name, value in counters:
+            self.counters[(document, page, name)] += value
+
+    def get_rows(self):
+        rows = [{'document': document, 'page': page, 'kind': 'timer', 'name': stage, 'value': round(seconds, 6), 'calls': calls}
+                for (document, page, stage), (seconds, calls) in self.timers.items()]
+        rows += [{'document': document, 'page': page, 'kind': 'counter', 'name': name, 'value': value, 'calls': None}
+                 for (document, page, name), value in self.counters.items()]
+        return sorted(rows, key=lambda row: (row['document'] or '', row['page'] or 0, row['kind'], row['name']))
+
+    def get_report(self):
+        """Per document: totals per stage (pages added up), counters and the per-page breakdown."""
+        documents = defaultdict(lambda: {'stages': defaultdict(lambda: {'seconds': 0.0, 'calls': 0}),
+                                         'counters': defaultdict(int), 'pages': defaultdict(dict)})
+        for row in self.get_rows():
+            document = documents[row['document'] or '(run)']
+            if row['kind'] == 'timer':
+                document['stages'][row['name']]['seconds'] += row['value']
+                document['stages'][row['name']]['calls'] += row['calls']
+            else:
+                document['counters'][row['name']] += row['value']
+            if row['page'] is not None:
+                document['pages'][row['page']][row['name']] = row['value']
+        return json.loads(json.dumps(documents))
+
+    def write_report(self, directory=config.METRICS_DIR):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / 'metrics.json', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.get_report(), indent=1))
+        with open(directory / 'metrics.csv', 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['document', 'page', 'kind', 'name', 'value', 'calls'])
+            writer.writeheader()
+            writer.writerows(self.get_rows())
+        logger.info(f'Metrics report written to {directory}')
+
+    def log_summary(self):
+        for name, document in self.get_report().items():
+            stages = sorted(document['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+            logger.info(f'{name}: ' + ', '.join(f"{stage} {totals['seconds']:.2f}s" for stage, totals in stages))
+
+metrics = Metrics()
+
+def in_ranges(page_number, ranges):
+    return any(first <= page_number and (last is None or page_number <= last) for first, last in ranges or [])
+
+@contextmanager
+def profile(name, profiler=config.PROFILER):
+    """Profiles the block with cProfile (<name>.prof, for pstats/snakeviz) or,
+    with profiler='torch', with torch.profiler (<name>.json, a Chrome trace)."""
+    directory = Path(config.METRICS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    if profiler == 'torch':
+        import torch
+        from torch.profiler import profile as torch_profile, ProfilerActivity
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with torch_profile(activities=activities, record_shapes=True) as prof:
+            yield
+        prof.export_chrome_trace(str(directory / f'{name}.json'))
+    else:
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(directory / f'{name}.prof')
+    logger.info(f'Profile written to {directory / name}')
@@ -0,0 +1,117 @@
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import config
+import utils
+from columns import infer_pages
+from model_registry import registry
+from rendering import get_renderer
+
+logger = logging.getLogger("table_generator")
+
+class EasyOcrEngine:
+    """Runs EasyOCR and shapes its output like a Vision page (blocks/paragraphs/words/symbols)."""
+
+    def __init__(self, languages=config.LOCAL_OCR_LANGUAGES):
+        import easyocr
+        self.reader = easyocr.Reader(languages, gpu=registry.device == 'cuda', verbose=False)
+
+    def read(self, images):
+        # readtext_batched needs images of the same size: crops are padded with white instead of being
+        # resized, so the boxes it returns stay in each crop's own pixel coordinates
+        if not images:
+            return []
+        height = max(image.height for image in images)
+        width = max(image.width for image in images)
+        canvases = []
+        for image in images:
+            canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+            canvas[:image.height, :image.width] = np.asarray(image)
+            canvases.append(canvas)
+        return self.reader.readtext_batched(canvases, batch_size=config.BATCH_SIZE)
+
+def get_words(detections, offset, page_size):
+    """Turns EasyOCR text boxes inside a crop into Vision-like words, normalized to the whole page.
+    EasyOCR boxes may hold several words: the box is split proportionally to each word's length."""
+    x_offset, y_offset = offset
+    page_width, page_height = page_size
+    words = []
+    for box, text, confidence in detections:
+        xs, ys = [point[0] for point in box], [point[1] for point in box]
+        left, right = min(xs) + x_offset, max(xs) + x_offset
+        top, bottom = (min(ys) + y_offset) / page_height, (max(ys) + y_offset) / page_height
+        char_width = (right - left) / max(len(text), 1)
+        position = 0
+        for part in text.split(' '):
+            if part:
+                word_left = (left + position * char_width) / page_width
+                word_right = (left + (position + len(part)) * char_width) / page_width
+                words.append({
+                    'boundingBox': {'normalizedVertices': [
+                        {'x': word_left, 'y': top}, {'x': word_right, 'y': top},
+                        {'x': word_right, 'y': bottom}, {'x': word_left, 'y': bottom}]},
+                    'symbols': [{'text': char, 'confidence': float(confidence)} for char in part],
+                    'confidence': float(confidence),
+                })
+            position += len(part) + 1
+    return words
+
+def get_response(deskewed_path, page_number, words):
+    page = get_renderer(Path(deskewed_path)).document[page_number - 1]
+    annotation = {'width': page.rect.width, 'height': page.rect.height,
+                  'blocks': [{'paragraphs': [{'words': words}]}] if words else []}
+    return {
+        'fullTextAnnotation': {'pages': [annotation]},
+        'context': {'uri': f'{Path(deskewed_path).name}', 'pageNumber': page_number},
+    }
+
+_engine = None
+
+def init_worker():
+    global _engine
+    registry.warm_up()
+    _engine = EasyOcrEngine()
+
+def ocr_pages(deskewed_path, page_numbers):
+    """OCRs only the table regions found by the detector on each page, returning Vision-like responses."""
+    global _engine
+    if _engine is None:
+        _engine = EasyOcrEngine()
+    inferers = infer_pages(deskewed_path, page_numbers)
+    crops, owners = [], []
+    for page_number in page_numbers:
+        inferer = inferers[page_number]
+        for table in inferer.tables:
+            bbox = table['object']['bbox']
+            crops.append(inferer.image.crop(bbox))
+            owners.append((page_number, (bbox[0], bbox[1]), inferer.image.size))
+    words = {page_number: [] for page_number in page_numbers}
+    for (page_number, offset, size), detections in zip(owners, _engine.read(crops)):
+        words[page_number].extend(get_words(detections, offset, size))
+    return [get_response(deskewed_path, page_number, words[page_number]) for page_number in page_numbers]
+
+def run(deskewed_path, workers=1):
+    """OCRs a whole PDF locally and writes the responses where Vision results are downloaded to,
+    in the same files layout (<document>.jsonoutput-<first>-to-<last>.json), so joining works unchanged."""
+    deskewed_path = Path(deskewed_path)
+    page_count = len(get_renderer(deskewed_path))
+    chunks = list(utils.chunked(range(1, page_count + 1), config.BATCH_SIZE))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker) as executor:
+            results = executor.map(ocr_pages, [deskewed_path] * len(chunks), chunks)
+            responses = [response for chunk in results for response in chunk]
+    else:
+        responses = [response for chunk in chunks for response in ocr_pages(deskewed_path, chunk)]
+
+    output_name = deskewed_path.with_suffix('.json').name
+    for start in range(0, len(responses), config.OCR_BATCH_SIZE):
+        batch = responses[start:start + config.OCR_BATCH_SIZE]
+        with open(Path(config.OCRED_PAGES_DIR) / f'{output_name}output-{start + 1}-to-{start + len(batch)}.json', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'responses': batch}))
+    logger.info(f'Local OCR finished: {deskewed_path.name} ({page_count} pages)')
@@ -1,11 +1,19 @@
 import utils
-from models import TokenSet, Table
+import ocr_store
+import stages
+import writers
+import pdfilust
+import local_ocr
+import deskew
+from pipeline import TableGenerator
+from instrumentation import metrics
 from glob import glob
 import config
-import os
+import shutil
 from pathlib import Path
 import logging
 import sys
+import argparse
 
 logger = logging.getLogger("table_generator")
 logger.addHandler(logging.StreamHandler(sys.stdout))
@@ -17,39 +25,237 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
-if __name__ == '__main__':
-    
+DESKEW_PARAMS = ['native', config.DESKEW_DPI, config.DESKEW_MAX_ANGLE, config.DESKEW_ANGLE_STEP, config.DESKEW_ANGLE_THRESHOLD]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Extracts tables from the PDFs in 01_original_files')
+    parser.add_argument('--workers', type=int, default=config.WORKERS,
+                        help='Number of processes generating tables (each one loads its own models)')
+    parser.add_argument('--pages', type=utils.parse_page_ranges, default=None,
+                        help='Pages to extract tables from, e.g. "1-50,120,300-" (default: every page)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only shows which stages and pages are stale and would be rebuilt')
+    parser.add_argument('--rebuild-ocr', action='store_true',
+                        help='Lets documents already read by Google Vision be deskewed and sent again when they '
+                             'or the DESKEW_* parameters change (every page is billed again)')
+    parser.add_argument('--profile-pages', type=utils.parse_page_ranges,
+                        default=utils.parse_page_ranges(config.PROFILE_PAGES) if config.PROFILE_PAGES else None,
+                        help=f'Profiles the table extraction of these pages with {config.PROFILER} (output in {config.METRICS_DIR})')
+    return parser.parse_args()
+
+class Document:
+    """Runs the stages of one PDF, skipping the ones whose inputs and parameters haven't changed."""
+
+    def __init__(self, file, dry_run=False, rebuild_ocr=False):
+        self.path = Path(file)
+        self.prefix = self.path.with_suffix('').name
+        self.deskewed_path = Path(f"{config.DESKEWED_FILES_DIR}/{self.path.name}")
+        self.complete_ocr_path = Path(f"{config.JOINED_OCRED_DIR}/{self.prefix}.json")
+        self.store_path = ocr_store.get_store_path(self.prefix)
+        self.state = stages.DocumentState(self.prefix)
+        self.dry_run = dry_run
+        self.rebuild_ocr = rebuild_ocr
+        self.plan = []
+        self.failed = False
+
+    def is_stale(self, stage, get_key, output_exists):
+        # During a dry run nothing upstream is actually rebuilt, so everything after a stale stage is stale too
+        if self.dry_run and self.plan:
+            return True
+        return self.state.is_stale(stage, get_key(), output_exists)
+
+    def get_deskew_key(self):
+        return stages.get_key(self.state.file_digest(self.path), DESKEW_PARAMS if config.DESKEW else 'copy')
+
+    def get_ocred_pages(self):
+        return glob(f'{config.OCRED_PAGES_DIR}/{self.prefix}*')
+
+    def get_join_inputs(self):
+        return self.get_ocred_pages() or ([self.complete_ocr_path] if self.complete_ocr_path.exists() else [])
+
+    def count_csv_files(self):
+        if 'csv' not in config.OUTPUT_FORMATS:
+            return None
+        return {page_number: len(paths) for page_number, paths in writers.get_csv_files(self.prefix).items()}
+
+    def keeps_paid_ocr(self, stage):
+        # A new deskewed file means a new Google Vision request for every page: unless --rebuild-ocr is given,
+        # documents that already have Vision results keep their deskewed file (and the results matching it)
+        if config.OCR_ENGINE != 'vision' or self.rebuild_ocr or not self.get_join_inputs():
+            return False
+        logger.warning(f'{self.path.name}: {stage} is stale but rebuilding it means paying Google Vision for the whole document again, '
+                       'keeping the current files (run with --rebuild-ocr to rebuild them)')
+        return True
+
     #DESKEWING
-    for file in glob(f'{config.ORIGINAL_FILES_DIR}/*.pdf'):
-        path = Path(file)
-        deskewed_path = Path(f"{config.DESKEWED_FILES_DIR}/{path.name}")
-        if not deskewed_path.exists():
-            logger.info(f'Deskewing: {path.name}')
-            os.system(f'sudo docker run --rm -i jbarlow83/ocrmypdf-alpine - - -d -s <"{file}" >"{deskewed_path.absolute().__str__()}"')
-        else:
-            logger.info(f"DESKEWED {path.name} already present, skipping step...")
-    
-    #GET GOOGLE VISION RESPONSE
-        complete_ocr_path = Path(f"{config.JOINED_OCRED_DIR}/{path.with_suffix('').name}.json")
-        # utils.join_all_pages(path.with_suffix('').name)
-        if not complete_ocr_path.exists():
-            logger.info(f'Getting Google Vision response: {path.name}')
-            utils.get_google_vision_response(deskewed_path)
-            utils.join_all_pages(path.with_suffix('').name)
-        else:
-            logger.info(f"GOOGLE VISION {path.name} already present, skipping step...")
+    def deskew(self, workers=1):
+        if not self.is_stale('deskew', self.get_deskew_key, self.deskewed_path.exists()):
+            logger.info(f"DESKEWED {self.path.name} already present, skipping step...")
+            return
+        if self.deskewed_path.exists() and self.keeps_paid_ocr('deskew'):
+            return
+        self.plan.append(('deskew', self.path.name))
+        if self.dry_run:
+            return
+        with metrics.scope(self.path.name), metrics.timer('deskew'):
+            if config.DESKEW:
+                logger.info(f'Deskewing: {self.path.name}')
+                deskew.deskew_file(self.path, self.deskewed_path, workers=workers)
+            else:
+                shutil.copyfile(self.path, self.deskewed_path)
+        self.state.mark('deskew', self.get_deskew_key())
+        self.state.save()
+
+    def get_ocr_key(self):
+        digest = self.state.file_digest(self.deskewed_path)
+        if config.OCR_ENGINE == 'vision':
+            return digest
+        return stages.get_key(digest, config.OCR_ENGINE, config.LOCAL_OCR_LANGUAGES)
+
+    #GET GOOGLE VISION RESPONSE (every stale document is sent at once, see main)
+    def needs_ocr(self):
+        # Pages straight from OCR or only the joined JSON of an older run: either way the document was already read
+        ocr_exists = bool(self.get_join_inputs())
+        if config.OCR and self.is_stale('ocr', self.get_ocr_key, ocr_exists):
+            if ocr_exists and self.keeps_paid_ocr('ocr'):
+                return False
+            self.plan.append(('ocr', self.deskewed_path.name))
+            return not self.dry_run
+        logger.info(f"GOOGLE VISION {self.path.name} already present, skipping step...")
+        return False
+
+    def finish_ocr(self, error):
+        if error:
+            self.failed = True
+            return
+        self.state.mark('ocr', self.get_ocr_key())
+        self.state.save()
+
+    #JOIN (results of OCR pages, or an already joined JSON from older runs)
+    def join(self):
+        if not config.JOIN or not self.is_stale('join', lambda: self.state.files_digest(self.get_join_inputs()), self.store_path.exists()):
+            return
+        self.plan.append(('join', self.store_path.name))
+        if self.dry_run:
+            return
+        with metrics.scope(self.path.name), metrics.timer('join'):
+            if self.get_ocred_pages():
+                utils.join_all_pages(self.prefix)
+            elif self.complete_ocr_path.exists():
+                logger.info(f'Indexing joined OCR results: {self.path.name}')
+                ocr_store.build_from_json(self.complete_ocr_path, self.store_path)
+            else:
+                return
+        self.state.mark('join', self.state.files_digest(self.get_join_inputs()))
+        self.state.save()
 
     #GET TABLES
-        logger.info(f'Generating table: {path.name}')
-        for page_number, (page, metadata) in enumerate(utils.get_pages_from_file(complete_ocr_path), start=1):
-            if page_number > 50: continue
-            logger.info(f'Extracting page - {page_number:04}')
+    def extract_tables(self, generator, pages=None):
+        if self.dry_run and self.plan:
+            self.plan.append(('tables', 'every page'))
+            self.state.log_plan(self.path.name, self.plan)
+            return
+        if self.failed or not self.store_path.exists():
+            logger.error(f'No OCR results found for {self.path.name}')
+            return
+
+        store = ocr_store.open_store(self.store_path)
+        deskewed_digest = self.state.file_digest(self.deskewed_path)
+        # Pages outside the selection are never read from the store nor rendered
+        page_keys = {page_number: stages.get_page_keys(deskewed_digest, store.get_page_digest(page_number))
+                     for page_number in utils.select_pages(len(store), pages)
+                     if store.get_metadata(page_number)}
+        stale = self.state.get_stale_pages(page_keys, self.count_csv_files())
+        parquet_path = writers.get_parquet_path(self.prefix)
+        if 'parquet' in config.OUTPUT_FORMATS and not parquet_path.exists():
+            stale['parquet'] = list(page_keys)
+        overlay_path = pdfilust.get_overlay_path(self.prefix)
+        if config.GRID and pdfilust.get_overlay_source(overlay_path) != deskewed_digest:
+            # Missing, or drawn over another version of the deskewed PDF: redrawn from scratch
+            stale['grid'] = list(page_keys)
+        page_numbers = sorted(set().union(*stale.values()))
+        for stage, stale_pages in stale.items():
+            if stale_pages:
+                self.plan.append((stage, f'{len(stale_pages)} of {len(page_keys)} pages'))
+        if self.dry_run:
+            self.state.log_plan(self.path.name, self.plan)
+            return
+
+        # Every page run again rewrites its CSVs: the old ones go first, so tables a page no longer has don't linger
+        if 'csv' in config.OUTPUT_FORMATS:
+            csv_files = writers.get_csv_files(self.prefix)
+            for page_number in page_numbers:
+                for path in csv_files.get(page_number, []):
+                    path.unlink()
+
+        # Records of the stale pages replace theirs in the document's Parquet file and overlay, the other pages are kept
+        parquet = writers.ParquetWriter(parquet_path, replace_pages=page_numbers) \
+            if 'parquet' in config.OUTPUT_FORMATS and page_numbers else None
+        overlay = pdfilust.OverlayWriter(self.deskewed_path, overlay_path, deskewed_digest, replace_pages=page_numbers) \
+            if config.GRID and page_numbers else None
+        document_writers = [writer for writer in (parquet, overlay) if writer]
+        written = {}
+
+        def on_results(results, records):
+            if parquet:
+                parquet.extend(records.get('parquet', []))
+            if overlay:
+                overlay.extend(records.get('grid', []))
+            if document_writers:
+                # Pages are only marked once their records are in the files, i.e. on close
+                written.update({page_number: page_keys[page_number] for page_number, error in results if not error})
+                return
+            self.state.mark_pages({page_number: page_keys[page_number] for page_number, error in results if not error},
+                                  self.count_csv_files())
+            self.state.save()
+
+        utils.reset_peak_rss()
+        logger.info(f'Generating table: {self.path.name} ({len(page_numbers)} of {len(page_keys)} pages stale)')
+        try:
+            generator.run(self.deskewed_path, self.store_path, page_numbers, on_results)
+        except BaseException:
+            for writer in document_writers:
+                writer.abort()
+            raise
+        if document_writers:
+            for writer in document_writers:
+                writer.close()
+            self.state.mark_pages(written, self.count_csv_files())
+            self.state.save()
+        peak_rss = f'Peak RSS for {self.path.name}: {utils.get_peak_rss_mb():.0f} MB'
+        if generator.worker_peak_rss_mb:
+            peak_rss += f' (main process), {generator.worker_peak_rss_mb:.0f} MB (largest worker)'
+        logger.info(peak_rss)
+
+if __name__ == '__main__':
+    args = parse_args()
+    documents = [Document(file, dry_run=args.dry_run, rebuild_ocr=args.rebuild_ocr) for file in glob(f'{config.ORIGINAL_FILES_DIR}/*.pdf')]
+    for document in documents:
+        document.deskew(workers=args.workers)
+
+    ocr_pending = {document.deskewed_path: document for document in documents if document.needs_ocr()}
+    if ocr_pending and config.OCR_ENGINE == 'local':
+        for deskewed_path, document in ocr_pending.items():
+            logger.info(f'Running local OCR: {deskewed_path.name}')
             try:
-                if metadata:
-                    table = Table(tokens = utils.get_tokens_from_words(utils.get_words_from_results(page)),
-                                metadata = metadata)
-                else:
-                    raise IndexError('No metadata found')
-            except IndexError as e:
-                logger.error(e)
-            table.save_csv()# run()
\ No newline at end of file
+                with metrics.scope(deskewed_path.name), metrics.timer('ocr'):
+                    local_ocr.run(deskewed_path, workers=args.workers)
+                document.finish_ocr(None)
+            except Exception as e:
+                logger.error(f'Local OCR failed for {deskewed_path.name}: {e!r}')
+                document.finish_ocr(repr(e))
+    elif ocr_pending:
+        logger.info(f'Getting Google Vision response: {len(ocr_pending)} documents')
+        with metrics.timer('ocr'):
+            responses = utils.get_google_vision_responses(list(ocr_pending))
+        for deskewed_path, error in responses.items():
+            ocr_pending[deskewed_path].finish_ocr(error)
+
+    with TableGenerator(workers=args.workers, profile_pages=args.profile_pages) as generator:
+        for document in documents:
+            document.join()
+            document.extract_tables(generator, pages=args.pages)
+
+    if not args.dry_run:
+        metrics.log_summary()
+        metrics.write_report()
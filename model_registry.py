@@ -0,0 +1,85 @@
+import time
+import logging
+
+import torch
+from transformers import AutoModelForObjectDetection, TableTransformerForObjectDetection
+
+import config
+import accelerated
+from instrumentation import metrics
+
+logger = logging.getLogger("table_generator")
+
+MODEL_SPECS = {
+    'detection': (AutoModelForObjectDetection, config.DETECTION_MODEL, config.DETECTION_MODEL_REVISION, config.TABLE_RESIZE),
+    'structure': (TableTransformerForObjectDetection, config.STRUCTURE_MODEL, config.STRUCTURE_MODEL_REVISION, config.CROPPED_RESIZE),
+}
+
+class ModelRegistry:
+    """Loads each TATR model once and keeps it resident (eval mode) for the whole process."""
+
+    def __init__(self, device=None, backend=config.INFERENCE_BACKEND):
+        self.backend = backend
+        # Accelerated backends are CPU only
+        self.device = device or ("cuda" if torch.cuda.is_available() and backend == 'eager' else "cpu")
+        self._models = {}
+        self._stats = {}
+
+    def __contains__(self, name):
+        return name in self._models
+
+    def get(self, name):
+        if name not in self._models:
+            self._models[name] = self._load(name)
+        return self._models[name]
+
+    @property
+    def detection(self):
+        return self.get('detection')
+
+    @property
+    def structure(self):
+        return self.get('structure')
+
+    def _load(self, name):
+        model_class, model_id, revision, _ = MODEL_SPECS[name]
+        start = time.perf_counter()
+        if self.backend in accelerated.EXPORTED_SUFFIXES:
+            model = accelerated.load_exported(name, self.backend)
+        else:
+            model = model_class.from_pretrained(model_id, revision=revision)
+            model.to(self.device)
+            model.eval()
+            if self.backend == 'quantized':
+                model = accelerated.quantize(model)
+        resident_bytes = accelerated.get_resident_bytes(model)
+        metrics.add('model_load', time.perf_counter() - start)
+        self._stats[name] = {
+            'model': model_id,
+            'revision': revision,
+            'device': self.device,
+            'backend': self.backend,
+            'load_seconds': round(time.perf_counter() - start, 3),
+            'resident_mb': round(resident_bytes / 2**20, 1),
+        }
+        logger.info(f"Loaded {name} model {model_id}@{revision} in {self._stats[name]['load_seconds']}s")
+        return model
+
+    def warm_up(self, names=tuple(MODEL_SPECS)):
+        # Loads the weights and runs one dummy forward pass so the first page doesn't pay for it
+        for name in names:
+            model = self.get(name)
+            size = MODEL_SPECS[name][3]
+            start = time.perf_counter()
+            with torch.no_grad():
+                model(torch.zeros((1, 3, size, size), device=self.device))
+            self._stats[name]['warm_up_seconds'] = round(time.perf_counter() - start, 3)
+
+    def report(self):
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def log_report(self):
+        for name, stats in self.report().items():
+            logger.info(f"Model {name}: " + ", ".join(f"{key}={value}" for key, value in stats.items()))
+
+registry = ModelRegistry()
@@ -1,4 +1,6 @@
 import functools
+import sys
+import numpy as np
 import pandas as pd
 import math
 from typing import List
@@ -6,9 +8,11 @@ from dataclasses import dataclass
 import string
 from collections import defaultdict
 import logging
-from columns import TableInferer
+from columns import TableInferer, infer_pages
+from instrumentation import metrics
 from pathlib import Path
-from config import GAP_BETWEEN_LINES, DESKEWED_FILES_DIR, OUTPUT_TABLES_FILES_DIR
+from config import GAP_BETWEEN_LINES, DESKEWED_FILES_DIR, OUTPUT_TABLES_FILES_DIR, TABLE_REGION_PADDING
+from spatial import GridIndex
 
 logger = logging.getLogger("table_generator")
 
@@ -20,19 +24,111 @@ class Point:
     def __repr__(self):
         return f'X:{self.x:.3f} Y:{self.y:.3f}'
 
+DATA_TYPES = ('number', 'text', 'punctuation')
+
+@functools.lru_cache(maxsize=2**16)
+def get_data_type(text: str) -> str:
+    counts = defaultdict(int)
+    for char in text:
+        if char.isdigit():
+            counts['number'] += 1
+        elif char.isalpha():
+            counts['text'] += 1
+        elif char in string.punctuation:
+            counts['punctuation'] += 1
+
+    if counts['number'] >= counts['text'] and counts['number'] > counts['punctuation']:
+        data_type = 'number'
+    elif counts['text'] >= counts['number'] and counts['text'] > counts['punctuation']:
+        data_type = 'text'
+    else:
+        data_type = 'punctuation'
+    return data_type
+
+class TokenArray:
+    """Columnar storage for the tokens of a page; Token objects are views over one of its rows."""
+
+    def __init__(self, left, top, right, bottom, confidence, texts: List[str]) -> None:
+        self.left = np.asarray(left, dtype=np.float64)
+        self.top = np.asarray(top, dtype=np.float64)
+        self.right = np.asarray(right, dtype=np.float64)
+        self.bottom = np.asarray(bottom, dtype=np.float64)
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self.texts = [sys.intern(text) for text in texts]
+        self.data_types = np.array([DATA_TYPES.index(get_data_type(text)) for text in self.texts], dtype=np.int8)
+        self.row = np.zeros(len(self.texts), dtype=np.int64)
+        self.column = np.zeros(len(self.texts), dtype=np.int64)
+
+    @classmethod
+    def from_rectangles(cls, rectangles, texts: List[str], confidences):
+        # Rectangles come as OCR normalized vertices [left, top y, right, bottom y], with y growing downwards
+        rectangles = np.asarray(rectangles, dtype=np.float64).reshape(-1, 4)
+        return cls(rectangles[:, 0], 1 - rectangles[:, 1], rectangles[:, 2], 1 - rectangles[:, 3], confidences, texts)
+
+    @classmethod
+    def from_tokens(cls, tokens: List['Token']):
+        return cls([token.left for token in tokens], [token.top for token in tokens],
+                   [token.right for token in tokens], [token.bottom for token in tokens],
+                   [token.confidence for token in tokens], [token.text for token in tokens])
+
+    @property
+    def x_center(self) -> np.ndarray:
+        return (self.left + self.right)/2
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Token index out of range')
+        return Token.view(self, index)
+
 class Token:
+    __slots__ = ('_array', '_index')
+
     def __init__(self, rectangle:List, symbols:List, confidence:float) -> None:
-        self.rectangle = rectangle
-        self.symbols = symbols
-        self.confidence = confidence
-        self.left = self.rectangle[0]
-        self.top = 1-self.rectangle[1]
-        self.right = self.rectangle[2]
-        self.bottom = 1 - self.rectangle[3]
-    
+        text = ''.join(char.get('text',' ') for char in symbols)
+        self._array = TokenArray.from_rectangles([rectangle], [text], [confidence])
+        self._index = 0
+
+    @classmethod
+    def view(cls, array: TokenArray, index: int) -> 'Token':
+        token = cls.__new__(cls)
+        token._array = array
+        token._index = index
+        return token
+
+    @property
+    def left(self) -> float:
+        return float(self._array.left[self._index])
+
+    @property
+    def top(self) -> float:
+        return float(self._array.top[self._index])
+
+    @property
+    def right(self) -> float:
+        return float(self._array.right[self._index])
+
+    @property
+    def bottom(self) -> float:
+        return float(self._array.bottom[self._index])
+
+    @property
+    def confidence(self) -> float:
+        return float(self._array.confidence[self._index])
+
+    @property
+    def rectangle(self) -> List[float]:
+        return [self.left, 1-self.top, self.right, 1-self.bottom]
+
     @property
     def text(self) -> str:
-        return ''.join(char.get('text',' ') for char in self.symbols)
+        return self._array.texts[self._index]
 
     @property
     def x_center(self) -> float:
@@ -48,30 +144,33 @@ class Token:
 
     @property
     def data_type(self) -> str:
-        counts = defaultdict(int)
-        for char in self.text:
-            if char.isdigit():
-                counts['number'] += 1
-            elif char.isalpha():
-                counts['text'] += 1
-            elif char in string.punctuation:
-                counts['punctuation'] += 1
-
-        if counts['number'] >= counts['text'] and counts['number'] > counts['punctuation']:
-            data_type = 'number'
-        elif counts['text'] >= counts['number'] and counts['text'] > counts['punctuation']:
-            data_type = 'text'
-        else:
-            data_type = 'punctuation'
-        return data_type
+        return DATA_TYPES[self._array.data_types[self._index]]
+
+    @property
+    def row(self) -> int:
+        return int(self._array.row[self._index])
+
+    @row.setter
+    def row(self, value: int):
+        self._array.row[self._index] = value
+
+    @property
+    def column(self) -> int:
+        return int(self._array.column[self._index])
+
+    @column.setter
+    def column(self, value: int):
+        self._array.column[self._index] = value
 
     def __repr__(self):
         return f'Y:{self.top:.3f} X:{self.left:.3f} ---- "{self.text}" ({self.confidence:.02f})'
 
 class TokenSet:
     
-    def __init__(self, tokens: list, metadata: dict) -> None:
-        self.tokens=tokens
+    def __init__(self, tokens: TokenArray, metadata: dict, inferer: TableInferer = None) -> None:
+        self.tokens = tokens if isinstance(tokens, TokenArray) else TokenArray.from_tokens(tokens)
+        if inferer is not None:
+            self.inferer = inferer
         self.page_number = metadata.get('pageNumber')
         self.filepath = self.extract_filepath(metadata)
         self.width = metadata.get('width')
@@ -100,111 +199,160 @@ class TokenSet:
     def extract_filepath(self, metadata):
         return Path(DESKEWED_FILES_DIR) / metadata.get('uri').split('/')[-1]
 
+    @functools.cached_property
+    def sorted_indices(self) -> np.ndarray:
+        # Top to bottom, then left to right (lexsort is stable, like sorted())
+        return np.lexsort((self.tokens.left, -self.tokens.top))
+
     @property
     def sorted_tokens(self) -> list:
-        return sorted(
-            self.tokens,
-            key=lambda token: (-token.top, token.left),
-        )
+        return [self.tokens[index] for index in self.sorted_indices]
 
     # def truncate_values(self, values: list, truncate: int):
     #     return [round(value, truncate) for value in values]
 
-    def _get_all_values(self, attribute: str):
+    def _get_all_values(self, attribute: str) -> np.ndarray:
         assert attribute in ['top', 'left', 'right', 'bottom'], 'Invalid attribute name'
-        return [getattr(token, attribute) for token in self.tokens]
+        return getattr(self.tokens, attribute)
     
     @property
     def min_bottom(self):
-        return min(self._get_all_values('bottom'))
+        return float(self._get_all_values('bottom').min())
     
     @property
     def max_top(self):
-        return max(self._get_all_values('top'))
+        return float(self._get_all_values('top').max())
     
     @property
     def min_left(self):
-        return min(self._get_all_values('left'))
+        return float(self._get_all_values('left').min())
     
     @property
     def max_right(self):
-        return max(self._get_all_values('right'))
+        return float(self._get_all_values('right').max())
     
     # def max_text_position(self):
     #     max(token.left for token in self.tokens if token.data_type=='text')
     
-    @property
-    @functools.lru_cache()
+    def get_row_indices(self, indices: np.ndarray = None) -> List[np.ndarray]:
+        # Rows of every token on the page, or only of the given token indices
+        with metrics.timer('rows', self.page_number):
+            if indices is None:
+                order = self.sorted_indices
+            else:
+                order = indices[np.lexsort((self.tokens.left[indices], -self.tokens.top[indices]))]
+            # A new row starts whenever a token is more than GAP_BETWEEN_LINES away from the first token of the current row
+            row_starts = []
+            prev_y = math.inf
+            for position, top in enumerate(self.tokens.top[order].tolist()):
+                if abs(top - prev_y) > GAP_BETWEEN_LINES:
+                    row_starts.append(position)
+                    prev_y = top
+            row_indices = []
+            for index, (start, end) in enumerate(zip(row_starts, row_starts[1:] + [len(order)])):
+                indices = order[start:end]
+                indices = indices[np.argsort(self.tokens.left[indices], kind='stable')]
+                self.tokens.row[indices] = index
+                row_indices.append(indices)
+            return row_indices
+
+    @functools.cached_property
+    def row_indices(self) -> List[np.ndarray]:
+        return self.get_row_indices()
+
+    @functools.cached_property
     def rows(self):
-        new_row, rows = [], []
-        prev_y = math.inf
-        for token in self.sorted_tokens:
-            is_new_row = bool(abs(token.top - prev_y) > GAP_BETWEEN_LINES)
-            if is_new_row:
-                rows.append(new_row)
-                new_row=[]
-                prev_y = token.top
-            new_row.append(token)
-            new_row.sort(key=lambda token: token.left)
-        rows.append(new_row)
-        rows = list(filter(None, rows))
-        for index, row in enumerate(rows):
-            for token in row:
-                token.row=index
-        return rows
+        return [[self.tokens[index] for index in indices] for indices in self.row_indices]
     
-    @property
-    @functools.lru_cache()
+    @functools.cached_property
+    def inferer(self) -> TableInferer:
+        # Only rendered and run through the models when something actually needs the columns
+        return infer_pages(self.filepath, [self.page_number])[self.page_number]
+
+    @functools.cached_property
     def columns(self):
-        inferer = TableInferer(self.filepath, self.page_number)
-        return inferer.get_columns()
+        return self.inferer.get_columns()
+
+    @functools.cached_property
+    def spatial_index(self) -> GridIndex:
+        return GridIndex(self.tokens.x_center, (self.tokens.top + self.tokens.bottom)/2)
+
+    @functools.cached_property
+    def table_indices(self) -> List[np.ndarray]:
+        # Tokens of each table (same order as the column packs): the ones centered inside its detected region,
+        # so headers, footnotes and other tables on the page are left out. A None region means the whole page
+        padding = TABLE_REGION_PADDING
+        regions = self.inferer.get_table_regions()
+        with metrics.timer('clip', self.page_number):
+            return [np.arange(len(self.tokens)) if region is None else
+                    self.spatial_index.query(region[0] - padding, region[1] + padding, region[2] + padding, region[3] - padding)
+                    for region in regions]
     
-    def get_positions(self, index):
-        for pack_index, column_pack in enumerate(self.columns, start=1):
-            if pack_index != index: continue
-            for row_index, row in enumerate(self.rows, start=1):
-                for token in row:
-                    token.row = row_index
-                    for column_index, column_threshold in enumerate(column_pack, start=1):
-                        if token.x_center <= column_threshold:
-                        # if token.left <= column_threshold:
-                            token.column = column_index
-                            break
-                    else:
-                        token.column = len(column_pack) + 1
+    def get_positions(self, index, indices: np.ndarray = None):
+        # Column thresholds are sorted, so a token's column is the first threshold >= its x center (1-based),
+        # or one past the last threshold
+        column_pack = self.columns[index - 1]
+        if indices is None:
+            self.tokens.column[:] = np.searchsorted(column_pack, self.tokens.x_center, side='left') + 1
+        else:
+            self.tokens.column[indices] = np.searchsorted(column_pack, self.tokens.x_center[indices], side='left') + 1
                     
+    @functools.cached_property
+    def cell_indices(self) -> List[List[List[List[int]]]]:
+        # For each table, its rows of cells, each cell holding the indices of its tokens from left to right
+        packs = []
+        # Columns (vision work) and rows are timed on their own
+        column_packs, table_indices = self.columns, self.table_indices
+        for pack_index, column_pack in enumerate(column_packs, start=1):
+            row_indices = self.get_row_indices(table_indices[pack_index - 1])
+            with metrics.timer('cell_assignment', self.page_number):
+                self.get_positions(pack_index, table_indices[pack_index - 1])
+                columns = self.tokens.column
+                table = []
+                for indices in row_indices:
+                    cells = [[] for _ in range(len(column_pack) + 1)]
+                    for index, column in zip(indices.tolist(), columns[indices].tolist()):
+                        cells[column - 1].append(index)
+                    table.append(cells)
+                packs.append(table)
+        return packs
+
+    def get_cell_text(self, cell: List[int]) -> str:
+        return ' '.join(self.tokens.texts[index] for index in cell).split(':')[0] if cell else ''
+
     def get_dataframe(self):
-        
-        table = []
-        dfs = []
-        for pack_index, column_pack in enumerate(self.columns, start=1):
-            self.get_positions(pack_index)
-            for _, row in enumerate(self.rows, start=1):
-                new_row = []
-                for column_index in range(1, len(column_pack) + 2 ):
-                    cell_tokens = [token for token in row if token.column==column_index]
-                    if cell_tokens:
-                        # min_confidence = min(token.confidence for token in cell_tokens)
-                        text = ' '.join(token.text for token in cell_tokens)
-                        new_row.append(text.split(':')[0])# + f' [[{min_confidence}]]')
-                    else:
-                        new_row.append('')
-                table.append(new_row)
-            dfs.append(pd.DataFrame(table))
-        return dfs
+        cell_indices = self.cell_indices
+        with metrics.timer('dataframe', self.page_number):
+            return [pd.DataFrame([[self.get_cell_text(cell) for cell in row] for row in table]) for table in cell_indices]
+
+    def get_records(self):
+        """One record per non-empty cell: (document, page, table, row, column, text, mean confidence, token confidences).
+        Tables are numbered from 1 like the CSV files; rows and columns from 0 like their DataFrames."""
+        document = self.filepath.with_suffix('').name
+        records = []
+        for table_index, table in enumerate(self.cell_indices, start=1):
+            for row_index, row in enumerate(table):
+                for column_index, cell in enumerate(row):
+                    if cell:
+                        confidences = self.tokens.confidence[cell].tolist()
+                        records.append((document, self.page_number, table_index, row_index, column_index,
+                                        self.get_cell_text(cell), sum(confidences)/len(confidences), confidences))
+        return records
                 
 class Table(TokenSet):
 
-    def __init__(self, tokens: list, metadata: dict) -> None:
-        super().__init__(tokens, metadata)
-        self.dfs = self.get_dataframe()
+    @functools.cached_property
+    def dfs(self):
+        return self.get_dataframe()
     
     def save_csv(self, filename = None):
-        for index, df in enumerate(self.dfs, start=1):
-            filename = f"{self.filepath.with_suffix('').name}---{self.page_number:04}_{index:02}.csv"
-            df.to_csv(
-                Path(OUTPUT_TABLES_FILES_DIR) / filename,
-                index=False)
+        dfs = self.dfs
+        with metrics.timer('csv', self.page_number):
+            for index, df in enumerate(dfs, start=1):
+                filename = f"{self.filepath.with_suffix('').name}---{self.page_number:04}_{index:02}.csv"
+                df.to_csv(
+                    Path(OUTPUT_TABLES_FILES_DIR) / filename,
+                    index=False)
         
     def run(self):
         ...
@@ -0,0 +1,241 @@
+import json
+import time
+import random
+import asyncio
+import logging
+import shutil
+from pathlib import Path
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+class OperationFailed(RuntimeError):
+    """The OCR operation finished with an error: polling it again won't change that, it has to be resubmitted."""
+
+class ObjectStore:
+    """Where PDFs are uploaded to and OCR results are downloaded from."""
+
+    def uri(self, name):
+        raise NotImplementedError
+
+    async def upload(self, filepath: Path):
+        raise NotImplementedError
+
+    async def download(self, prefix: str, destination: Path):
+        raise NotImplementedError
+
+class Annotator:
+    """Submits a PDF already in the object store for OCR and polls the long running operation."""
+
+    async def submit(self, source_uri: str, destination_uri: str) -> str:
+        raise NotImplementedError
+
+    async def is_done(self, operation_name: str) -> bool:
+        raise NotImplementedError
+
+async def run_command(*args):
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(f'{" ".join(args)} failed: {stderr.decode(errors="replace").strip()}')
+
+class GcsObjectStore(ObjectStore):
+
+    def __init__(self, bucket=config.BUCKET_NAME):
+        self.bucket = bucket
+
+    def uri(self, name):
+        return f'gs://{self.bucket}/{name}'
+
+    async def upload(self, filepath):
+        await run_command('gsutil', '-m', 'cp', str(filepath), self.uri(''))
+
+    async def download(self, prefix, destination):
+        await run_command('gsutil', '-m', 'cp', self.uri(f'{prefix}*.json'), str(destination))
+
+class VisionAnnotator(Annotator):
+
+    def __init__(self, batch_size=config.OCR_BATCH_SIZE):
+        from google.cloud import vision
+        self.vision = vision
+        self.client = vision.ImageAnnotatorClient()
+        self.batch_size = batch_size
+
+    async def submit(self, source_uri, destination_uri):
+        vision = self.vision
+        feature = vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)
+        input_config = vision.InputConfig(gcs_source=vision.GcsSource(uri=source_uri), mime_type="application/pdf")
+        output_config = vision.OutputConfig(
+            gcs_destination=vision.GcsDestination(uri=destination_uri), batch_size=self.batch_size
+        )
+        text_detection_params = vision.TextDetectionParams(enable_text_detection_confidence_score=True)
+        image_context = vision.ImageContext(text_detection_params=text_detection_params)
+        async_request = vision.AsyncAnnotateFileRequest(
+            features=[feature], input_config=input_config, output_config=output_config, image_context=image_context
+        )
+        operation = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.client.async_batch_annotate_files(requests=[async_request]))
+        return operation.operation.name
+
+    async def is_done(self, operation_name):
+        # Looked up by name, so operations submitted by a previous (interrupted) run can be resumed
+        operation = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.client.transport.operations_client.get_operation(operation_name))
+        if operation.done and operation.error.code:
+            raise OperationFailed(f'OCR operation {operation_name} failed: {operation.error.message}')
+        return operation.done
+
+class LocalObjectStore(ObjectStore):
+    """A directory standing in for the bucket (tests and offline runs)."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def uri(self, name):
+        return str(self.directory / name)
+
+    async def upload(self, filepath):
+        shutil.copyfile(filepath, self.directory / Path(filepath).name)
+
+    async def download(self, prefix, destination):
+        for path in self.directory.glob(f'{prefix}*.json'):
+            shutil.copyfile(path, Path(destination) / path.name)
+
+class FakeAnnotator(Annotator):
+    """Writes canned Vision responses next to the uploaded PDF, in the same files Vision would produce.
+    responses maps a PDF name to its list of per-page responses; PDFs without canned responses get blank pages.
+    Operations finish delay seconds after being submitted, with an error for the PDFs in failing. The due time
+    (and the failure) is kept in the operation name, so another instance can resume polling it like Vision would."""
+
+    def __init__(self, responses=None, batch_size=config.OCR_BATCH_SIZE, delay=0, failing=()):
+        self.responses = responses or {}
+        self.batch_size = batch_size
+        self.delay = delay
+        self.failing = set(failing)
+        self.submitted = []
+
+    async def submit(self, source_uri, destination_uri):
+        import fitz
+        source = Path(source_uri)
+        responses = self.responses.get(source.name)
+        if responses is None:
+            with fitz.open(source) as document:
+                responses = [{'context': {'uri': source_uri, 'pageNumber': page_number}}
+                             for page_number in range(1, document.page_count + 1)]
+        for start in range(0, len(responses), self.batch_size):
+            batch = responses[start:start + self.batch_size]
+            with open(f'{destination_uri}output-{start + 1}-to-{start + len(batch)}.json', 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'responses': batch}))
+        self.submitted.append(source.name)
+        return f"fake/{source.name}/{time.time() + self.delay}/{'failed' if source.name in self.failing else 'ok'}"
+
+    async def is_done(self, operation_name):
+        _, _, due, outcome = operation_name.rsplit('/', 3)
+        if time.time() < float(due):
+            return False
+        if outcome == 'failed':
+            raise OperationFailed(f'OCR operation {operation_name} failed')
+        return True
+
+class OcrClient:
+    """Uploads, submits and polls many documents concurrently. Progress is kept in a state file,
+    so an interrupted run resumes each document from its last completed step instead of resubmitting it."""
+
+    def __init__(self, object_store: ObjectStore, annotator: Annotator, destination=config.OCRED_PAGES_DIR,
+                 concurrency=config.OCR_CONCURRENCY, retries=config.OCR_RETRIES,
+                 poll_interval=config.OCR_POLL_INTERVAL, timeout=config.OCR_TIMEOUT, state_path=config.OCR_STATE_PATH):
+        self.object_store = object_store
+        self.annotator = annotator
+        self.destination = Path(destination)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.state_path = Path(state_path)
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                self.state = json.loads(f.read())
+        except FileNotFoundError:
+            self.state = {}
+
+    def _save_state(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.state, indent=1))
+        tmp_path.replace(self.state_path)
+
+    def _set_state(self, filepath, **values):
+        self.state[filepath.name] = {**self.state.get(filepath.name, {}), **values}
+        self._save_state()
+
+    async def _retry(self, description, function, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return await function(*args)
+            except OperationFailed:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logger.warning(f'{description} failed ({e!r}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def process(self, filepath: Path):
+        filepath = Path(filepath)
+        output_name = filepath.with_suffix('.json').name
+        stat = filepath.stat()
+        source = [stat.st_size, stat.st_mtime_ns]
+        step = self.state.get(filepath.name, {})
+        if step.get('source') != source:
+            # Not started yet, or the PDF changed since it was submitted
+            step = {}
+            self.state[filepath.name] = {'source': source}
+
+        if not step.get('uploaded'):
+            await self._retry(f'Uploading {filepath.name}', self.object_store.upload, filepath)
+            self._set_state(filepath, uploaded=True)
+
+        operation_name = step.get('operation')
+        if not operation_name:
+            operation_name = await self._retry(
+                f'Submitting {filepath.name}', self.annotator.submit,
+                self.object_store.uri(filepath.name), self.object_store.uri(output_name))
+            self._set_state(filepath, operation=operation_name)
+
+        # A timed out or interrupted operation stays in the state and is polled again by the next run;
+        # a failed one is dropped, so the next run submits the document again
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        try:
+            while not await self._retry(f'Polling {filepath.name}', self.annotator.is_done, operation_name):
+                if asyncio.get_running_loop().time() > deadline:
+                    raise TimeoutError(f'OCR of {filepath.name} did not finish in {self.timeout}s')
+                await asyncio.sleep(self.poll_interval)
+        except OperationFailed:
+            self.state[filepath.name].pop('operation', None)
+            self._save_state()
+            raise
+
+        await self._retry(f'Downloading {filepath.name}', self.object_store.download, output_name, self.destination)
+        self.state.pop(filepath.name, None)
+        self._save_state()
+        logger.info(f'OCR finished: {filepath.name}')
+
+    async def run(self, filepaths):
+        """Returns a {filepath: error or None} dict; a failed document doesn't stop the others."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(filepath):
+            async with semaphore:
+                try:
+                    await self.process(filepath)
+                except Exception as e:
+                    logger.error(f'OCR failed for {Path(filepath).name}: {e!r}')
+                    return filepath, repr(e)
+                return filepath, None
+
+        return dict(await asyncio.gather(*(bounded(filepath) for filepath in filepaths)))
@@ -0,0 +1,119 @@
+import json
+import hashlib
+import shutil
+from array import array
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+import config
+import utils
+from models import TokenArray
+
+# Layout of a <document>.ocr directory:
+#   page_offsets.npy   int64 (pages + 1)      first word of each page
+#   geometry.npy       float64 (words, 5)     left, top, right, bottom, confidence (Vision coordinates)
+#   text_offsets.npy   int64 (words + 1)      byte range of each word inside text.npy
+#   text.npy           uint8                  UTF-8 text of every word, concatenated
+#   pages.json         list                   metadata of each page ({} for pages without text)
+GEOMETRY_COLUMNS = ('left', 'top', 'right', 'bottom', 'confidence')
+
+class OcrStoreWriter:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.page_offsets = array('q', [0])
+        self.geometry = array('d')
+        self.text_offsets = array('q', [0])
+        self.text = bytearray()
+        self.pages = []
+
+    def add(self, response: dict):
+        page, metadata = utils.split_page(response)
+        for words in utils.get_words_from_results(page) if metadata else []:
+            for word in words:
+                self.geometry.extend(utils.get_word_rectangle(word))
+                self.geometry.append(word['confidence'])
+                self.text += utils.get_word_text(word).encode('utf-8')
+                self.text_offsets.append(len(self.text))
+        self.page_offsets.append(len(self.text_offsets) - 1)
+        self.pages.append(metadata)
+
+    def close(self):
+        # Written next to the final location and swapped in, so readers never see half a store
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        np.save(tmp_path / 'page_offsets.npy', np.frombuffer(self.page_offsets, dtype=np.int64))
+        np.save(tmp_path / 'geometry.npy', np.frombuffer(self.geometry, dtype=np.float64).reshape(-1, len(GEOMETRY_COLUMNS)))
+        np.save(tmp_path / 'text_offsets.npy', np.frombuffer(self.text_offsets, dtype=np.int64))
+        np.save(tmp_path / 'text.npy', np.frombuffer(bytes(self.text), dtype=np.uint8))
+        with open(tmp_path / 'pages.json', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.pages))
+        shutil.rmtree(self.path, ignore_errors=True)
+        tmp_path.rename(self.path)
+
+class OcrStore:
+    """Random access to the OCR words of any page; the arrays are memory-mapped, so only the pages read are loaded."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.page_offsets = np.load(self.path / 'page_offsets.npy')
+        self.geometry = np.load(self.path / 'geometry.npy', mmap_mode='r')
+        self.text_offsets = np.load(self.path / 'text_offsets.npy', mmap_mode='r')
+        self.text = np.load(self.path / 'text.npy', mmap_mode='r')
+        with open(self.path / 'pages.json', encoding='utf-8') as f:
+            self.pages = json.loads(f.read())
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        for page_number in range(1, len(self) + 1):
+            yield page_number, self.get_tokens(page_number), self.get_metadata(page_number)
+
+    def _word_range(self, page_number):
+        return self.page_offsets[page_number - 1], self.page_offsets[page_number]
+
+    def get_metadata(self, page_number):
+        return self.pages[page_number - 1]
+
+    def get_geometry(self, page_number):
+        start, end = self._word_range(page_number)
+        return self.geometry[start:end]
+
+    def get_texts(self, page_number):
+        start, end = self._word_range(page_number)
+        offsets = self.text_offsets[start:end + 1]
+        if not len(offsets) or offsets[0] == offsets[-1]:
+            return [''] * (end - start)
+        text = self.text[offsets[0]:offsets[-1]].tobytes()
+        offsets = offsets - offsets[0]
+        return [text[begin:finish].decode('utf-8') for begin, finish in zip(offsets[:-1], offsets[1:])]
+
+    def get_page_digest(self, page_number):
+        start, end = self._word_range(page_number)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(self.geometry[start:end]).tobytes())
+        digest.update(self.text[self.text_offsets[start]:self.text_offsets[end]].tobytes())
+        digest.update(json.dumps(self.get_metadata(page_number), sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_tokens(self, page_number):
+        geometry = self.get_geometry(page_number)
+        return TokenArray.from_rectangles(geometry[:, :4], self.get_texts(page_number), geometry[:, 4])
+
+def get_store_path(prefix: str):
+    return Path(config.JOINED_OCRED_DIR) / f'{prefix}.ocr'
+
+@lru_cache(maxsize=4)
+def open_store(path):
+    return OcrStore(path)
+
+def build_from_json(json_path, path):
+    """Indexes an already joined JSON file (documents processed before the store existed)."""
+    writer = OcrStoreWriter(path)
+    for response in utils.iter_json_array(json_path):
+        writer.add(response)
+    writer.close()
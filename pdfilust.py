@@ -1,80 +1,162 @@
-#!pip install pymupdf 
-#!pip install dpath
-
-
-
-#Lê o documento original
-import fitz  
-doc = fitz.open('./pag9.pdf')
-
-
-#Lê o resultado do OCR
-import json 
-with open('pag9_resultado.json') as f:
-    data = json.loads(f.read())
-
-#Extrai as dimensões do documento
-dims =  data['responses'][0]['fullTextAnnotation']['pages'][0]
-WIDTH,HEIGHT = dims['width'], dims['height']
-    
-#Extrai as palavras do resultado do OCR
-import dpath.util
-results = []
-for x,r in dpath.util.search(data,'responses/*/fullTextAnnotation/pages/*/blocks/*/paragraphs/*/words',yielded=True):
-    results.append(r)
-
-
-####################################################################################            
-    
-#Desenha retangulos no PDF com as palavras lidas correspondentes na posição correspondente
-for page in doc:
-    for n,words in enumerate(results):
-        for word in words:
-            verts = word['boundingBox']['normalizedVertices']
-            x1, y1 = verts[0]['x'] * WIDTH, verts[0]['y'] * HEIGHT
-            x2, y2 = verts[2]['x'] * WIDTH, verts[2]['y']  * HEIGHT
-            rect = [x1,y1,x2,y2]
-            text = ''.join(char.get('text',' ') for char in word['symbols'])
-            page.add_freetext_annot(rect, text, fontsize=6.5,text_color=(1,0,0), fill_color=(1,1,1))
-
-doc.save('./TEST_PAG9_PALAVRAS.pdf')
-
-####################################################################################            
-
-#Idem para "blocos"
-results = []
-for x,r in dpath.util.search(data,'responses/*/fullTextAnnotation/pages/*/blocks',yielded=True):
-    results.append(r)
-   
-    
-for page in doc:
-    for n,blocks in enumerate(results):
-        for block in blocks:
-            verts = block['boundingBox']['normalizedVertices']
-            x1, y1 = verts[0]['x'] * WIDTH, verts[0]['y'] * HEIGHT
-            x2, y2 = verts[2]['x'] * WIDTH, verts[2]['y']  * HEIGHT
-            rect = [x1,y1,x2,y2]
-            page.add_freetext_annot(rect, '', fontsize=6.5, border_color=(0,1,0))
-            
-results = []
-
-
-####################################################################################            
-
-#Idem para "parágrafos"
-for x,r in dpath.util.search(data,'responses/*/fullTextAnnotation/pages/*/blocks/*/paragraphs',yielded=True):
-    results.append(r)
-    
-
-for page in doc:
-    for n,blocks in enumerate(results):
-        for block in blocks:
-            verts = block['boundingBox']['normalizedVertices']
-            x1, y1 = verts[0]['x'] * WIDTH, verts[0]['y'] * HEIGHT
-            x2, y2 = verts[2]['x'] * WIDTH, verts[2]['y']  * HEIGHT
-            rect = [x1,y1,x2,y2]
-            page.add_freetext_annot(rect, '', fontsize=6.5, border_color=(0,0,1))
-
-####################################################################################            
-            
-doc.save('./TEST_PAG9_ALL_OBJS.pdf')
\ No newline at end of file
+import os
+import sys
+import logging
+import argparse
+from pathlib import Path
+
+import fitz
+import numpy as np
+
+import config
+
+logger = logging.getLogger("table_generator")
+
+# Annotations are tagged with this author and their kind, so a rerun can replace the ones of the pages it rebuilds
+AUTHOR = 'table_generator'
+COLORS = {
+    'words': (0.6, 0.6, 0.6),
+    'tables': (1, 0, 0),
+    'columns': (1, 0.5, 0),
+    'cells': (0, 0.6, 0),
+    'labels': (0, 0, 1),
+}
+LABEL_SIZE = 5
+SOURCE_KEYWORD = 'table_generator-source:' # Digest of the PDF an overlay was drawn over, kept in its keywords
+
+def get_overlay_path(prefix: str):
+    return Path(config.DEBUG_GRID_FILES_DIR) / f'{prefix}.pdf'
+
+def get_overlay_source(path):
+    """Digest of the PDF the overlay at path was drawn over, or None if there is no (tagged) overlay."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with fitz.open(path) as document:
+        keywords = document.metadata.get('keywords') or ''
+    return keywords[len(SOURCE_KEYWORD):] if keywords.startswith(SOURCE_KEYWORD) else None
+
+def get_word_overlay(page_number, tokens):
+    # Word boxes as OCR normalized vertices [left, top y, right, bottom y], y growing downwards
+    words = np.column_stack([tokens.left, 1 - tokens.top, tokens.right, 1 - tokens.bottom]).astype(np.float32)
+    return {'page': page_number, 'words': words, 'tables': [], 'columns': [], 'cells': [], 'labels': []}
+
+def get_page_overlay(table):
+    """What the overlay draws for a page, in OCR coordinates: word boxes, table regions, the column lines of each table,
+    the boxes of the non-empty cells and the row/column indices (0-based, like the DataFrames) as (x, y, text) labels.
+    Small and picklable, so workers send it back to the process writing the document's overlay."""
+    overlay = get_word_overlay(table.page_number, table.tokens)
+    words = overlay['words']
+    regions = table.inferer.get_table_regions()
+    for region, column_pack, rows in zip(regions, table.columns, table.cell_indices):
+        # Regions are in token coordinates (y growing upwards); None means the whole page
+        left, top, right, bottom = (0, 0, 1, 1) if region is None else (region[0], 1 - region[1], region[2], 1 - region[3])
+        overlay['tables'].append((left, top, right, bottom))
+        overlay['columns'].extend((x, top, x, bottom) for x in column_pack)
+        edges = [left, *column_pack, right]
+        overlay['labels'].extend(((start + end)/2, top, f'c{index}') for index, (start, end) in enumerate(zip(edges, edges[1:])))
+        for row_index, row in enumerate(rows):
+            for cell in row:
+                if cell:
+                    boxes = words[cell]
+                    overlay['cells'].append((boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()))
+            row_top = min((words[cell, 1].min() for cell in row if cell), default=None)
+            if row_top is not None:
+                overlay['labels'].append((left, row_top, f'r{row_index}'))
+    return overlay
+
+def add_strokes(page, kind, strokes, width):
+    # A single ink annotation per kind holds every box or line of the page
+    if not strokes:
+        return
+    annot = page.add_ink_annot(strokes)
+    annot.set_colors(stroke=COLORS[kind])
+    annot.set_border(width=width)
+    annot.set_info(title=AUTHOR, subject=kind)
+    annot.update()
+
+def draw_page(page, overlay):
+    width, height = page.rect.width, page.rect.height
+
+    def to_points(boxes):
+        return (np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * [width, height, width, height]).tolist()
+
+    for kind, line_width in (('words', 0.3), ('cells', 0.5), ('tables', 1.5)):
+        add_strokes(page, kind, [[(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]
+                                 for left, top, right, bottom in to_points(overlay[kind])], line_width)
+    add_strokes(page, 'columns', [[(x0, y0), (x1, y1)] for x0, y0, x1, y1 in to_points(overlay['columns'])], 1)
+    for x, y, text in overlay['labels']:
+        x, y = x * width, y * height
+        # Column labels sit above the table, row labels to the left of it (inside it for tables at the page edge)
+        if text[0] == 'c':
+            top = max(y - LABEL_SIZE - 3, 0)
+            rect = fitz.Rect(x - 8, top, x + 8, top + LABEL_SIZE + 3)
+        else:
+            left = max(x - 16, 0)
+            rect = fitz.Rect(left, y, left + 16, y + LABEL_SIZE + 3)
+        annot = page.add_freetext_annot(rect, text, fontsize=LABEL_SIZE, text_color=COLORS['labels'])
+        annot.set_info(title=AUTHOR, subject='labels')
+        annot.update(fontsize=LABEL_SIZE, text_color=COLORS['labels'])
+
+def clear_page(page):
+    for annot in list(page.annots()):
+        if annot.info.get('title') == AUTHOR:
+            page.delete_annot(annot)
+
+class OverlayWriter:
+    """Debug overlay of a whole document: a copy of its PDF with the page overlays drawn as vector annotations,
+    page by page as the results come, and saved once on close. Like ParquetWriter, the previous overlay is kept
+    and only the pages in replace_pages (every page if None) are redrawn, so a run that only rebuilds stale pages keeps the others.
+    The previous overlay is only kept if it was drawn over the same source (source_digest); otherwise the
+    source is started over and every page needs to be drawn again."""
+
+    def __init__(self, source_path, path, source_digest, replace_pages=None):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        self.source_digest = source_digest
+        self.document = fitz.open(source_path)
+        if self.path.exists():
+            self._carry_over(replace_pages)
+
+    def _carry_over(self, replace_pages):
+        if get_overlay_source(self.path) != self.source_digest:
+            logger.warning(f'{self.path.name} was drawn over another version of the document, redrawing it')
+            return
+        self.document.close()
+        self.document = fitz.open(self.path)
+        for page_number in range(1, self.document.page_count + 1) if replace_pages is None else replace_pages:
+            clear_page(self.document[page_number - 1])
+
+    def extend(self, overlays):
+        for overlay in overlays:
+            draw_page(self.document[overlay['page'] - 1], overlay)
+
+    def close(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.document.set_metadata({**self.document.metadata, 'keywords': f'{SOURCE_KEYWORD}{self.source_digest}'})
+        self.document.save(self.tmp_path, garbage=3, deflate=True)
+        self.document.close()
+        self.tmp_path.replace(self.path)
+
+    def abort(self):
+        # Leaves the previous file as it was
+        self.document.close()
+
+if __name__ == '__main__':
+    import utils
+    import stages
+    import ocr_store
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(description='Draws the OCR word boxes of a document over its PDF (no models), '
+                                                 f'in {config.DEBUG_GRID_FILES_DIR}<document>_ocr.pdf')
+    parser.add_argument('pdf', type=Path, help=f'PDF in {config.DESKEWED_FILES_DIR}, whose OCR is already joined')
+    parser.add_argument('--pages', type=utils.parse_page_ranges, default=None)
+    args = parser.parse_args()
+
+    prefix = args.pdf.with_suffix('').name
+    store = ocr_store.open_store(ocr_store.get_store_path(prefix))
+    writer = OverlayWriter(args.pdf, get_overlay_path(f'{prefix}_ocr'), stages.DocumentState(prefix).file_digest(args.pdf))
+    writer.extend(get_word_overlay(page_number, store.get_tokens(page_number))
+                  for page_number in utils.select_pages(len(store), args.pages) if store.get_metadata(page_number))
+    writer.close()
+    logger.info(f'Saved {writer.path}')
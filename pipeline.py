@@ -0,0 +1,229 @@
+import os
+import logging
+import multiprocessing
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+import config
+import utils
+import ocr_store
+import prefilter
+import writers
+import frame_pool
+from columns import infer_pages
+from models import Table
+from model_registry import registry
+from instrumentation import metrics, profile, in_ranges
+
+logger = logging.getLogger("table_generator")
+
+IN_WORKER = False
+
+def init_worker(threads):
+    global IN_WORKER
+    IN_WORKER = True
+    torch.set_num_threads(threads)
+    registry.warm_up()
+
+def extract_tables(deskewed_path, store_path, chunk, profile_pages=None, frames=None):
+    """Extracts and saves the tables of a chunk of page numbers, reading the pages that have a frame
+    (one per page of the chunk, or None) from the frame pool instead of rendering them.
+    Returns the (page_number, error) pairs, the records for the document writers by output (see writers.drain_records), the peak RSS (MB) of the process while doing it and, in a worker,
+    the metrics recorded meanwhile (None in-process, where they are already in the main process' metrics).
+    Chunks holding any of the profile_pages ranges are profiled."""
+    if IN_WORKER:
+        utils.reset_peak_rss()
+    deskewed_path = Path(deskewed_path)
+    profiler = nullcontext()
+    if any(in_ranges(page_number, profile_pages) for page_number in chunk):
+        profiler = profile(f'{deskewed_path.with_suffix("").name}_{chunk[0]:04}-{chunk[-1]:04}')
+    with metrics.scope(deskewed_path.name), profiler:
+        results, records = extract_pages(deskewed_path, store_path, chunk, dict(zip(chunk, frames or [])))
+    return results, records, utils.get_peak_rss_mb(), metrics.drain() if IN_WORKER else None
+
+def extract_pages(deskewed_path, store_path, chunk, frames=None):
+    store = ocr_store.open_store(store_path)
+    page_writers = writers.get_page_writers()
+    page_numbers = [page_number for page_number in chunk if store.get_metadata(page_number)]
+    page_numbers, skipped = prefilter.filter_pages(store, page_numbers)
+    try:
+        inferers = infer_pages(deskewed_path, page_numbers, frames=frames)
+    except Exception as e:
+        # Falls back to one inference per page so a single bad page doesn't take the whole chunk with it
+        logger.warning(f'Batched detection failed for pages {page_numbers}: {e!r}')
+        inferers = {}
+
+    results = []
+    for page_number in chunk:
+        if page_number in skipped:
+            logger.info(f'Skipping page - {page_number:04} (pre-filter score {skipped[page_number]:.2f})')
+            results.append((page_number, None))
+            continue
+        logger.info(f'Extracting page - {page_number:04}')
+        try:
+            metadata = store.get_metadata(page_number)
+            if not metadata:
+                raise IndexError('No metadata found')
+            with metrics.timer('tokens', page_number):
+                tokens = store.get_tokens(page_number)
+            table = Table(tokens = tokens,
+                          metadata = metadata,
+                          inferer = inferers.get(page_number))
+            for writer in page_writers:
+                writer.write(table)
+            results.append((page_number, None))
+        except Exception as e:
+            results.append((page_number, repr(e)))
+    return results, writers.drain_records(page_writers)
+
+class TableGenerator:
+    """Runs extract_tables over the pages of each document, either in-process or on a pool of workers with their own models.
+    With a pool and RENDER_WORKERS, pages are rendered ahead by separate processes into a shared memory frame pool."""
+
+    def __init__(self, workers=1, profile_pages=None):
+        self.workers = workers
+        self.profile_pages = profile_pages
+        self.executor = None
+        self.render_executor = None
+        self.frame_pool = None
+        self.started = False
+        self.worker_peak_rss_mb = 0
+
+    def __enter__(self):
+        return self
+
+    def _ensure_started(self):
+        # Models are only loaded once there is actually something to extract
+        if self.started:
+            return
+        if self.workers > 1:
+            self._start()
+        else:
+            if config.TORCH_THREADS:
+                torch.set_num_threads(config.TORCH_THREADS)
+            registry.warm_up()
+            registry.log_report()
+        self.started = True
+
+    def __exit__(self, *exc):
+        if self.executor:
+            self.executor.shutdown()
+        if self.render_executor:
+            self.render_executor.shutdown()
+        if self.frame_pool:
+            self.frame_pool.close()
+
+    def _start(self):
+        # Each worker gets its share of the cores, so the workers' inference threads don't oversubscribe them
+        threads = config.TORCH_THREADS or max(1, (os.cpu_count() or 1) // self.workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(threads,))
+        if config.RENDER_WORKERS and not self.render_executor:
+            # Enough slots for the chunks in flight on the workers plus the ones being rendered ahead
+            slots = config.FRAME_POOL_SLOTS or (self.workers * 2 + config.RENDER_WORKERS) * config.BATCH_SIZE
+            self.frame_pool = frame_pool.FramePool(slots)
+            self._start_renderers()
+
+    def _start_renderers(self):
+        self.render_executor = ProcessPoolExecutor(
+            max_workers=config.RENDER_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def _restart(self):
+        self.executor.shutdown(wait=False)
+        self._start()
+
+    def run(self, deskewed_path, store_path, page_numbers, on_results=None):
+        # Workers only receive page numbers and read the pages from the store themselves.
+        # A bounded number of chunks is kept in flight and collected in submission (= page) order;
+        # on_results is called with the (page_number, error) pairs and the records of each chunk as it completes
+        self.worker_peak_rss_mb = 0
+        if not page_numbers:
+            return
+        self._ensure_started()
+        pending = deque()
+        for chunk, frames, slots in self._iter_chunks(deskewed_path, page_numbers):
+            future = self.executor.submit(extract_tables, deskewed_path, store_path, chunk, self.profile_pages, frames) if self.executor else None
+            pending.append((chunk, future, self.executor, slots))
+            if len(pending) >= max(1, self.workers * 2):
+                self._collect(deskewed_path, store_path, *pending.popleft(), on_results)
+        while pending:
+            self._collect(deskewed_path, store_path, *pending.popleft(), on_results)
+
+    def _iter_chunks(self, deskewed_path, page_numbers):
+        # Yields (chunk, frames, frame pool slots). With render workers, chunks are submitted for rendering
+        # RENDER_WORKERS chunks ahead of the extraction, which only gets the frames (offset and size) of the pages
+        chunks = utils.chunked(page_numbers, config.BATCH_SIZE)
+        if not (self.frame_pool and self.executor):
+            for chunk in chunks:
+                yield chunk, None, []
+            return
+        rendering = deque()
+        for chunk in chunks:
+            slots = self.frame_pool.acquire(len(chunk))
+            future = self.render_executor.submit(frame_pool.render_frames, deskewed_path, self.frame_pool.name,
+                                                 self.frame_pool.slot_bytes, slots, chunk)
+            rendering.append((chunk, slots, future, self.render_executor))
+            if len(rendering) >= config.RENDER_WORKERS:
+                yield self._get_frames(*rendering.popleft())
+        while rendering:
+            yield self._get_frames(*rendering.popleft())
+
+    def _get_frames(self, chunk, slots, future, render_executor):
+        try:
+            frames, snapshot = future.result()
+            metrics.merge(snapshot)
+        except BrokenProcessPool:
+            # The extraction workers render the chunk themselves
+            logger.warning(f'A render worker crashed while rendering pages {chunk}')
+            frames = None
+            # Every chunk in flight on the crashed pool fails too: only the first one replaces it
+            if render_executor is self.render_executor:
+                self.render_executor.shutdown(wait=False)
+                self._start_renderers()
+        return chunk, frames, slots
+
+    def _collect(self, deskewed_path, store_path, chunk, future, executor, slots, on_results):
+        if future is None:
+            results, records, _, _ = extract_tables(deskewed_path, store_path, chunk, self.profile_pages)
+        else:
+            try:
+                results, records, peak_rss_mb, snapshot = future.result()
+                self.worker_peak_rss_mb = max(self.worker_peak_rss_mb, peak_rss_mb)
+                metrics.merge(snapshot)
+            except BrokenProcessPool:
+                if executor is self.executor:
+                    self._restart()
+                results, records = self._retry_pages(deskewed_path, store_path, chunk)
+        # The chunk is done with its pages: the slots can take the next ones
+        if self.frame_pool:
+            self.frame_pool.release(slots)
+        for page_number, error in results:
+            if error:
+                logger.error(f'{deskewed_path.name} - page {page_number:04}: {error}')
+        if on_results:
+            on_results(results, records)
+
+    def _retry_pages(self, deskewed_path, store_path, chunk):
+        # A worker died: every chunk in flight on that pool is lost, so each page is retried
+        # on its own to pin the crash on the page that caused it
+        results, records = [], {}
+        for page_number in chunk:
+            try:
+                page_results, page_records, _, snapshot = self.executor.submit(extract_tables, deskewed_path, store_path, [page_number]).result()
+                results.extend(page_results)
+                for output, output_records in page_records.items():
+                    records.setdefault(output, []).extend(output_records)
+                metrics.merge(snapshot)
+            except BrokenProcessPool:
+                results.append((page_number, 'worker crashed'))
+                self._restart()
+        return results, records
@@ -0,0 +1,133 @@
+import json
+import random
+import argparse
+import logging
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+import config
+import utils
+import ocr_store
+from columns import infer_pages
+from models import TokenArray, TokenSet, DATA_TYPES
+from instrumentation import metrics
+
+logger = logging.getLogger("table_generator")
+
+NUMBER = DATA_TYPES.index('number')
+
+def get_fingerprint():
+    return json.dumps({
+        'enabled': config.PREFILTER,
+        'threshold': config.PREFILTER_THRESHOLD,
+        'min_gap': config.PREFILTER_MIN_GAP,
+        'align_tolerance': config.PREFILTER_ALIGN_TOLERANCE,
+        'min_aligned_rows': config.PREFILTER_MIN_ALIGNED_ROWS,
+        'weights': config.PREFILTER_WEIGHTS,
+    }, sort_keys=True)
+
+def get_segments(tokens: TokenArray, row_indices):
+    """Splits every row where the horizontal gap between consecutive words is wider than PREFILTER_MIN_GAP,
+    so a segment is roughly a cell. Returns an array of (row, left, center, right) segments."""
+    segments = []
+    for row, indices in enumerate(row_indices):
+        left, right = tokens.left[indices], np.maximum.accumulate(tokens.right[indices])
+        starts = np.concatenate(([0], np.nonzero(left[1:] - right[:-1] > config.PREFILTER_MIN_GAP)[0] + 1))
+        ends = np.append(starts[1:], len(indices)) - 1
+        segments.extend(zip([row] * len(starts), left[starts], (left[starts] + right[ends]) / 2, right[ends]))
+    return np.array(segments, dtype=np.float64).reshape(-1, 4)
+
+def get_alignment(segments):
+    # A segment is aligned when its left edge, center or right edge is shared (within the tolerance)
+    # by segments of at least PREFILTER_MIN_ALIGNED_ROWS rows: that's what a column looks like
+    rows = segments[:, 0].astype(np.int64)
+    aligned = np.zeros(len(segments), dtype=bool)
+    for anchor in (1, 2, 3):
+        bins = np.floor(segments[:, anchor] / config.PREFILTER_ALIGN_TOLERANCE).astype(np.int64)
+        rows_per_bin = Counter(bin_ for bin_, _ in set(zip(bins.tolist(), rows.tolist())))
+        counts = np.array([rows_per_bin[bin_ - 1] + rows_per_bin[bin_] + rows_per_bin[bin_ + 1] for bin_ in bins.tolist()])
+        aligned |= counts >= config.PREFILTER_MIN_ALIGNED_ROWS
+    # Margins of running text align as well, but its lines aren't split into cells: only split rows count
+    first = np.r_[True, rows[1:] != rows[:-1]]
+    last = np.r_[rows[1:] != rows[:-1], True]
+    split = ~(first & last)
+    return float((aligned & split).sum() / len(segments))
+
+def get_regularity(segments, row_count):
+    # Share of rows split into the most common number (>= 2) of cells
+    cells_per_row = Counter(np.bincount(segments[:, 0].astype(np.int64), minlength=row_count).tolist())
+    multi = [count for cells, count in cells_per_row.items() if cells >= 2]
+    return max(multi, default=0) / row_count
+
+def score_page(tokens: TokenArray, metadata: dict):
+    """Scores how likely a page is to hold a table from its OCR tokens alone (no rendering, no models).
+    Returns the signals and their weighted 'score', from 0 to 1."""
+    signals = {'alignment': 0.0, 'regularity': 0.0, 'numeric': 0.0}
+    if len(tokens) >= 4:
+        row_indices = TokenSet(tokens, metadata).row_indices
+        segments = get_segments(tokens, row_indices)
+        signals['alignment'] = get_alignment(segments)
+        signals['regularity'] = get_regularity(segments, len(row_indices))
+        signals['numeric'] = float(np.mean(tokens.data_types == NUMBER))
+    signals['score'] = sum(weight * signals[signal] for signal, weight in config.PREFILTER_WEIGHTS.items())
+    return signals
+
+def filter_pages(store, page_numbers):
+    """Splits page numbers into (pages worth running the models on, {skipped page: score})."""
+    if not config.PREFILTER:
+        return list(page_numbers), {}
+    kept, skipped = [], {}
+    for page_number in page_numbers:
+        with metrics.timer('prefilter', page_number):
+            score = score_page(store.get_tokens(page_number), store.get_metadata(page_number))['score']
+        if score >= config.PREFILTER_THRESHOLD:
+            kept.append(page_number)
+        else:
+            skipped[page_number] = score
+            metrics.count('prefilter_skipped', 1, page_number)
+    return kept, skipped
+
+def evaluate(deskewed_path, store_path, page_numbers):
+    """Runs the detector on the given pages and returns (page_number, score, detector found a table) triples."""
+    store = ocr_store.open_store(store_path)
+    page_numbers = [page_number for page_number in page_numbers if store.get_metadata(page_number)]
+    samples = []
+    for chunk in utils.chunked(page_numbers, config.BATCH_SIZE):
+        inferers = infer_pages(deskewed_path, chunk)
+        for page_number in chunk:
+            score = score_page(store.get_tokens(page_number), store.get_metadata(page_number))['score']
+            samples.append((page_number, score, bool(inferers[page_number].tables)))
+    return samples
+
+def report(samples, thresholds):
+    """Precision/recall of "score >= threshold" as a predictor of the detector finding a table.
+    Recall is the one to watch: a missed page is a table that is never extracted."""
+    lines = []
+    positives = sum(detected for _, _, detected in samples)
+    for threshold in thresholds:
+        kept = [detected for _, score, detected in samples if score >= threshold]
+        true_positives = sum(kept)
+        precision = true_positives / len(kept) if kept else 1.0
+        recall = true_positives / positives if positives else 1.0
+        lines.append(f'threshold {threshold:.2f}: precision {precision:.3f}, recall {recall:.3f}, '
+                     f'{len(samples) - len(kept)} of {len(samples)} pages skipped')
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the OCR pre-filter with the table detector on a sample of pages')
+    parser.add_argument('pdf', type=Path, help='Deskewed PDF, already OCRed and joined')
+    parser.add_argument('--pages', type=utils.parse_page_ranges, default=None)
+    parser.add_argument('--sample', type=int, default=None, help='Random sample of this many pages from the selection')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, 0.15, 0.2, 0.25, 0.3, 0.4])
+    args = parser.parse_args()
+
+    store_path = ocr_store.get_store_path(args.pdf.with_suffix('').name)
+    page_numbers = utils.select_pages(len(ocr_store.open_store(store_path)), args.pages)
+    if args.sample and args.sample < len(page_numbers):
+        page_numbers = sorted(random.Random(0).sample(page_numbers, args.sample))
+    samples = evaluate(args.pdf, store_path, page_numbers)
+    print(f'{len(samples)} pages, {sum(detected for _, _, detected in samples)} with tables according to the detector')
+    for line in report(samples, args.thresholds):
+        print(line)
@@ -0,0 +1,49 @@
+from functools import lru_cache
+from pathlib import Path
+
+import fitz
+from PIL import Image
+
+import config
+from instrumentation import metrics
+
+class PageRenderer:
+    """Keeps a PDF open and rasterizes single pages on demand with PyMuPDF."""
+
+    def __init__(self, filepath, dpi=config.RENDER_DPI):
+        self.filepath = Path(filepath)
+        self.document = fitz.open(self.filepath)
+        self.dpi = dpi
+
+    def __len__(self):
+        return self.document.page_count
+
+    def get_zoom(self, page):
+        if self.dpi:
+            return self.dpi / 72
+        # The detector downscales the page to TABLE_RESIZE anyway, so there is no point in
+        # rendering at more than RENDER_OVERSAMPLE times that (the extra margin keeps table crops sharp)
+        return config.TABLE_RESIZE * config.RENDER_OVERSAMPLE / max(page.rect.width, page.rect.height)
+
+    def get_pixmap(self, page_number):
+        page = self.document[page_number - 1]
+        zoom = self.get_zoom(page)
+        with metrics.timer('render', page_number):
+            return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+
+    def render(self, page_number):
+        pixmap = self.get_pixmap(page_number)
+        # The PIL image is built from the pixmap samples directly (samples_mv, not the samples bytes copy),
+        # no intermediate encoding or RGB conversion
+        metrics.count('bytes_copied', pixmap.width * pixmap.height * 3, page_number)
+        return Image.frombuffer("RGB", (pixmap.width, pixmap.height), pixmap.samples_mv, "raw", "RGB", pixmap.stride, 1)
+
+    def close(self):
+        self.document.close()
+
+@lru_cache(maxsize=4)
+def get_renderer(filepath):
+    return PageRenderer(filepath)
+
+def render_page(filepath, page_number):
+    return get_renderer(Path(filepath)).render(page_number)
@@ -0,0 +1,38 @@
+import math
+
+import numpy as np
+
+import config
+
+class GridIndex:
+    """Uniform grid over the token centers of a page, in token coordinates (normalized, y growing upwards).
+    Tokens are sorted by grid cell, so the tokens of a run of cells in a grid row are a single slice and a box
+    query only looks at the cells it overlaps instead of at every token of the page."""
+
+    def __init__(self, x, y, cell_size=config.SPATIAL_CELL_SIZE):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.cell_size = cell_size
+        self.columns = math.ceil(1 / cell_size) + 1
+        keys = self._row(self.y) * self.columns + self._column(self.x)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def _column(self, x):
+        return np.clip(np.floor(np.asarray(x) / self.cell_size), 0, self.columns - 1).astype(np.int64)
+
+    def _row(self, y):
+        return np.clip(np.floor(np.asarray(y) / self.cell_size), 0, self.columns - 1).astype(np.int64)
+
+    def query(self, left, top, right, bottom):
+        """Indices (ascending) of the tokens whose center is inside the box, top being above bottom."""
+        first_column, last_column = self._column(left), self._column(right)
+        slices = []
+        for row in range(self._row(bottom), self._row(top) + 1):
+            start = np.searchsorted(self.keys, row * self.columns + first_column, side='left')
+            end = np.searchsorted(self.keys, row * self.columns + last_column, side='right')
+            slices.append(self.order[start:end])
+        candidates = np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+        x, y = self.x[candidates], self.y[candidates]
+        inside = (x >= left) & (x <= right) & (y >= bottom) & (y <= top)
+        return np.sort(candidates[inside])
@@ -0,0 +1,112 @@
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+import config
+from inference_cache import get_fingerprint as get_inference_fingerprint
+from prefilter import get_fingerprint as get_prefilter_fingerprint
+
+logger = logging.getLogger("table_generator")
+
+# Document stages run in this order; a stage is stale when its input digest or parameters
+# changed since it last ran, or when its output is gone. Table stages are tracked per page.
+DOCUMENT_STAGES = ('deskew', 'ocr', 'join')
+PAGE_STAGES = ('inference', 'grid', 'csv', 'parquet')
+
+def get_key(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_page_keys(deskewed_digest, page_digest):
+    inference = get_key(deskewed_digest, get_inference_fingerprint(), config.RENDER_DPI, config.RENDER_OVERSAMPLE)
+    csv = get_key(inference, page_digest, config.GAP_BETWEEN_LINES, config.SIMILARITY_THRESHOLD,
+                  get_prefilter_fingerprint(), config.TABLE_REGION_PADDING)
+    keys = {'inference': inference, 'csv': csv}
+    if config.GRID:
+        keys['grid'] = get_key(csv, 'grid')
+    if 'parquet' in config.OUTPUT_FORMATS:
+        keys['parquet'] = get_key(csv, 'parquet')
+    return keys
+
+class DocumentState:
+    """Manifest of what was last built for a document (pipeline_state/<document>.json)."""
+
+    def __init__(self, prefix):
+        self.path = Path(config.PIPELINE_STATE_DIR) / f'{prefix}.json'
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.loads(f.read())
+        except FileNotFoundError:
+            self.data = {}
+        self.data.setdefault('stages', {})
+        self.data.setdefault('pages', {})
+        self.data.setdefault('digests', {})
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.data, indent=1))
+        tmp_path.replace(self.path)
+
+    def file_digest(self, path):
+        # Digests are reused while the file's size and mtime stay the same, so unchanged PDFs aren't reread
+        path = Path(path)
+        stat = path.stat()
+        cached = self.data['digests'].get(str(path))
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            return cached['digest']
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            while chunk := f.read(2**20):
+                digest.update(chunk)
+        self.data['digests'][str(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def files_digest(self, paths):
+        return get_key(*[[Path(path).name, self.file_digest(path)] for path in sorted(paths)])
+
+    def is_stale(self, stage, key, output_exists):
+        if not output_exists:
+            return True
+        if stage not in self.data['stages']:
+            # Outputs produced before the manifest existed are adopted instead of rebuilt (OCR costs money)
+            self.mark(stage, key)
+            return False
+        return self.data['stages'][stage] != key
+
+    def mark(self, stage, key):
+        self.data['stages'][stage] = key
+
+    def get_stale_pages(self, page_keys, csv_files=None):
+        # csv_files: number of CSV files of each page found on disk. A page whose files don't match
+        # what was written when it was marked is stale for 'csv' even if its keys are up to date
+        stale = {stage: [] for stage in PAGE_STAGES}
+        for page_number, keys in page_keys.items():
+            built = self.data['pages'].get(str(page_number), {})
+            for stage, key in keys.items():
+                if built.get(stage) != key:
+                    stale[stage].append(page_number)
+            if csv_files is None or built.get('csv') != keys.get('csv'):
+                continue
+            if 'csv_files' not in built:
+                # Pages marked before the files were counted are adopted as they are
+                built['csv_files'] = csv_files.get(page_number, 0)
+            elif built['csv_files'] != csv_files.get(page_number, 0):
+                stale['csv'].append(page_number)
+        return stale
+
+    def mark_pages(self, page_keys, csv_files=None):
+        for page_number, keys in page_keys.items():
+            if csv_files is not None:
+                keys = {**keys, 'csv_files': csv_files.get(page_number, 0)}
+            self.data['pages'][str(page_number)] = keys
+
+    def log_plan(self, name, plan):
+        if not plan:
+            logger.info(f'{name}: up to date')
+        for stage, work in plan:
+            logger.info(f'{name}: {stage} -> {work}')
@@ -0,0 +1,100 @@
+import json
+import random
+from pathlib import Path
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+FONT = 'Helvetica'
+FONT_SIZE = 8
+MARGIN = 40
+ROW_HEIGHT = 14
+WORDS = ['Receita', 'Despesa', 'Total', 'Saldo', 'Ativo', 'Passivo', 'Custo', 'Estoque', 'Caixa', 'Juros',
+         'Impostos', 'Vendas', 'Capital', 'Reserva', 'Lucro', 'Provisão', 'Outros', 'Serviços']
+
+def get_word(text, left, baseline, page_width, page_height, confidence=0.99):
+    # Vision normalized vertices: top left, top right, bottom right, bottom left, with y growing downwards
+    right = left + stringWidth(text, FONT, FONT_SIZE)
+    top = (page_height - baseline - FONT_SIZE * 0.75) / page_height
+    bottom = (page_height - baseline + FONT_SIZE * 0.2) / page_height
+    left, right = left / page_width, right / page_width
+    return {
+        'boundingBox': {'normalizedVertices': [
+            {'x': left, 'y': top}, {'x': right, 'y': top}, {'x': right, 'y': bottom}, {'x': left, 'y': bottom}]},
+        'symbols': [{'text': char, 'confidence': confidence} for char in text],
+        'confidence': confidence,
+    }
+
+def draw_text(pdf, words, text, left, baseline, page_width, page_height):
+    pdf.drawString(left, baseline, text)
+    space = stringWidth(' ', FONT, FONT_SIZE)
+    for part in text.split(' '):
+        words.append(get_word(part, left, baseline, page_width, page_height))
+        left += stringWidth(part, FONT, FONT_SIZE) + space
+
+def get_cell_text(rng, row, column):
+    if row == 0:
+        return f'Coluna {column + 1}' if column else 'Conta'
+    if column == 0:
+        return ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+    return f'{rng.randint(0, 999_999):,}'.replace(',', '.')
+
+def draw_table_page(pdf, rng, rows, columns, page_width, page_height):
+    """Draws a ruled table and returns its Vision words, the ground truth cells and the column edges (0 to 1)."""
+    first_width = (page_width - 2 * MARGIN) * 0.3
+    column_width = (page_width - 2 * MARGIN - first_width) / max(columns - 1, 1)
+    edges = [MARGIN] + [MARGIN + first_width + column * column_width for column in range(columns)]
+    top = page_height - MARGIN
+    bottom = top - rows * ROW_HEIGHT
+    pdf.setLineWidth(0.5)
+    for edge in edges:
+        pdf.line(edge, top, edge, bottom)
+    for row in range(rows + 1):
+        pdf.line(edges[0], top - row * ROW_HEIGHT, edges[-1], top - row * ROW_HEIGHT)
+
+    words, cells = [], []
+    for row in range(rows):
+        baseline = top - (row + 1) * ROW_HEIGHT + (ROW_HEIGHT - FONT_SIZE) / 2 + 1
+        cells.append([])
+        for column in range(columns):
+            text = get_cell_text(rng, row, column)
+            cells[-1].append(text)
+            draw_text(pdf, words, text, edges[column] + 3, baseline, page_width, page_height)
+    return words, cells, [edge / page_width for edge in edges[1:]]
+
+def draw_text_page(pdf, rng, lines, page_width, page_height):
+    words = []
+    for line in range(lines):
+        text = ' '.join(rng.choice(WORDS).lower() for _ in range(12))
+        draw_text(pdf, words, text, MARGIN, page_height - MARGIN - line * ROW_HEIGHT, page_width, page_height)
+    return words
+
+def make_document(directory, name, pages, rows, columns, text_pages=0.0, seed=0):
+    """Writes <directory>/<name>.pdf and its Vision-like OCR (<name>.json, a joined array of page responses),
+    and returns the ground truth: for each page, its cells and column edges (None for running text pages)."""
+    directory = Path(directory)
+    rng = random.Random(seed)
+    page_width, page_height = A4
+    if rows * ROW_HEIGHT > page_height - 2 * MARGIN:
+        raise ValueError(f'{rows} rows do not fit in a page')
+    pdf = canvas.Canvas(str(directory / f'{name}.pdf'), pagesize=A4)
+    responses, truth = [], []
+    for page_number in range(1, pages + 1):
+        pdf.setFont(FONT, FONT_SIZE)
+        if rng.random() < text_pages:
+            words = draw_text_page(pdf, rng, rows, page_width, page_height)
+            truth.append(None)
+        else:
+            words, cells, edges = draw_table_page(pdf, rng, rows, columns, page_width, page_height)
+            truth.append({'cells': cells, 'edges': edges})
+        pdf.showPage()
+        responses.append({
+            'fullTextAnnotation': {'pages': [{'width': page_width, 'height': page_height,
+                                              'blocks': [{'paragraphs': [{'words': words}]}]}]},
+            'context': {'uri': f'gs://benchmark/{name}.pdf', 'pageNumber': page_number},
+        })
+    pdf.save()
+    with open(directory / f'{name}.json', 'w', encoding='utf-8') as f:
+        f.write(json.dumps(responses))
+    return truth
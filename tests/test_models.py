@@ -0,0 +1,65 @@
+import pytest
+
+import utils
+import models
+import synthetic
+from models import Table, TokenArray
+
+class FixedInferer:
+    """Known column packs instead of the models; None regions make every pack cover the whole page."""
+
+    def __init__(self, column_packs):
+        self.column_packs = column_packs
+
+    def get_columns(self):
+        return self.column_packs
+
+    def get_table_regions(self):
+        return [None] * len(self.column_packs)
+
+METADATA = {'pageNumber': 3, 'uri': 'gs://bucket/sample.pdf'}
+
+def get_sample_tokens():
+    # Two rows (y growing upwards) and three columns split at x = 0.3 and 0.6; "b" is centered exactly on a threshold
+    words = [
+        (0.10, 0.90, 0.20, 0.88, 'Conta'),
+        (0.40, 0.90, 0.50, 0.88, 'Total:'),
+        (0.25, 0.90, 0.35, 0.88, 'b'),
+        (0.70, 0.90, 0.80, 0.88, '1.234'),
+        (0.05, 0.80, 0.15, 0.78, 'Caixa'),
+        (0.16, 0.80, 0.26, 0.78, 'Geral'),
+        (0.72, 0.80, 0.78, 0.78, '99'),
+    ]
+    left, top, right, bottom, texts = zip(*words)
+    return TokenArray(left, top, right, bottom, [0.9] * len(texts), list(texts))
+
+def test_cells_of_a_sample_page():
+    table = Table(get_sample_tokens(), METADATA, inferer=FixedInferer([[0.3, 0.6]]))
+    [df] = table.get_dataframe()
+    # A token centered on a threshold belongs to the column on its left; text after ':' is dropped
+    assert df.values.tolist() == [['Conta b', 'Total', '1.234'],
+                                  ['Caixa Geral', '', '99']]
+
+def test_csv_of_a_sample_page(tmp_path, monkeypatch):
+    monkeypatch.setattr(models, 'OUTPUT_TABLES_FILES_DIR', str(tmp_path))
+    Table(get_sample_tokens(), METADATA, inferer=FixedInferer([[0.3, 0.6]])).save_csv()
+    assert [path.name for path in tmp_path.iterdir()] == ['sample---0003_01.csv']
+    assert (tmp_path / 'sample---0003_01.csv').read_text(encoding='utf-8') == \
+        '0,1,2\nConta b,Total,1.234\nCaixa Geral,,99\n'
+
+def test_packs_do_not_accumulate_rows():
+    table = Table(get_sample_tokens(), METADATA, inferer=FixedInferer([[0.3, 0.6], [0.5]]))
+    first, second = table.get_dataframe()
+    assert first.values.tolist() == [['Conta b', 'Total', '1.234'], ['Caixa Geral', '', '99']]
+    assert second.values.tolist() == [['Conta b Total', '1.234'], ['Caixa Geral', '99']]
+
+@pytest.mark.parametrize('seed', range(3))
+def test_synthetic_pages_match_ground_truth(tmp_path, seed):
+    truth = synthetic.make_document(tmp_path, 'sample', pages=2, rows=12, columns=5, seed=seed)
+    for page, metadata in utils.get_pages_from_file(tmp_path / 'sample.json'):
+        page_truth = truth[metadata['pageNumber'] - 1]
+        tokens = utils.get_tokens_from_words(utils.get_words_from_results(page))
+        [df] = Table(tokens, metadata, inferer=FixedInferer([page_truth['edges']])).get_dataframe()
+        # The last edge is the table's right border, so the column after it stays empty
+        assert [row[:-1] for row in df.values.tolist()] == page_truth['cells']
+        assert set(df.iloc[:, -1]) == {''}
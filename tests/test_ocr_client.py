@@ -0,0 +1,58 @@
+import json
+import asyncio
+
+import fitz
+import pytest
+
+from ocr_client import OcrClient, LocalObjectStore, FakeAnnotator, OperationFailed
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = tmp_path / 'doc.pdf'
+    with fitz.open() as document:
+        for _ in range(3):
+            document.new_page()
+        document.save(path)
+    return path
+
+def make_client(tmp_path, annotator, timeout=5):
+    destination = tmp_path / 'ocred'
+    destination.mkdir(exist_ok=True)
+    return OcrClient(LocalObjectStore(tmp_path / 'bucket'), annotator, destination=destination,
+                     retries=0, poll_interval=0.01, timeout=timeout, state_path=tmp_path / 'state' / 'requests.json')
+
+def read_state(tmp_path):
+    with open(tmp_path / 'state' / 'requests.json', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+def test_failed_operation_is_resubmitted(tmp_path, pdf):
+    failing = FakeAnnotator(failing=['doc.pdf'])
+    errors = asyncio.run(make_client(tmp_path, failing).run([pdf]))
+    assert 'OperationFailed' in errors[pdf]
+    # Still uploaded, but the dead operation isn't kept for the next run to poll
+    assert read_state(tmp_path)['doc.pdf'].get('uploaded') and 'operation' not in read_state(tmp_path)['doc.pdf']
+
+    annotator = FakeAnnotator()
+    assert asyncio.run(make_client(tmp_path, annotator).run([pdf])) == {pdf: None}
+    assert annotator.submitted == ['doc.pdf']
+    assert [path.name for path in (tmp_path / 'ocred').iterdir()] == ['doc.jsonoutput-1-to-3.json']
+    assert read_state(tmp_path) == {}
+
+def test_interrupted_operation_is_resumed(tmp_path, pdf):
+    slow = FakeAnnotator(delay=0.3)
+    errors = asyncio.run(make_client(tmp_path, slow, timeout=0.05).run([pdf]))
+    assert 'TimeoutError' in errors[pdf]
+    operation = read_state(tmp_path)['doc.pdf']['operation']
+
+    # A new run (and annotator) polls the same operation instead of submitting the document again
+    annotator = FakeAnnotator()
+    assert asyncio.run(make_client(tmp_path, annotator).run([pdf])) == {pdf: None}
+    assert annotator.submitted == []
+    assert operation.startswith('fake/doc.pdf/')
+    assert read_state(tmp_path) == {}
+
+def test_failed_operation_is_not_retried(tmp_path, pdf):
+    client = make_client(tmp_path, FakeAnnotator(failing=['doc.pdf']))
+    client.retries = 3
+    with pytest.raises(OperationFailed):
+        asyncio.run(client.process(pdf))
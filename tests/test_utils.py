@@ -0,0 +1,19 @@
+import json
+
+import pytest
+
+import utils
+
+ITEMS = [12345, 678, {'responses': [{'a': 'x' * 10}]}, 'text', -1.5e3, True, None, [1, [2, 3]]]
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 2**20])
+def test_iter_json_array_matches_json_loads(tmp_path, chunk_size):
+    path = tmp_path / 'items.json'
+    path.write_text(json.dumps(ITEMS), encoding='utf-8')
+    assert list(utils.iter_json_array(path, chunk_size=chunk_size)) == ITEMS
+
+def test_iter_json_array_rejects_other_documents(tmp_path):
+    path = tmp_path / 'object.json'
+    path.write_text('{"responses": []}', encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(utils.iter_json_array(path))
@@ -1,13 +1,14 @@
 import json
 from typing import Dict, List
-from models import Token
+from models import TokenArray
 import dpath
 from glob import glob
 import config
-import os
-from copy import deepcopy
-from pathlib import Path
-from google.cloud import vision
+import ocr_store
+import ocr_client
+from instrumentation import metrics
+import asyncio
+from itertools import islice
 
 def open_results_file(filepath: str):
     with open(filepath, encoding="utf-8") as f:
@@ -22,74 +23,150 @@ def get_words_from_results(data: Dict):
         words.append(word)
     return words
 
+def get_word_rectangle(word: Dict):
+    verts = word['boundingBox']['normalizedVertices']
+    try:
+        left, top = verts[0].get('x',0), verts[0]['y']
+        right, bottom = verts[2]['x'], verts[2]['y']
+    except KeyError:
+        left, top, bottom, right=0,0,0,0
+    return [left,top,right,bottom]
+
+def get_word_text(word: Dict):
+    return ''.join(char.get('text',' ') for char in word['symbols'])
+
 def get_tokens_from_words(results: List):
-    tokens = []
+    rectangles, texts, confidences = [], [], []
     for words in results:
         for word in words:
-            verts = word['boundingBox']['normalizedVertices']
-            try:
-                left, top = verts[0].get('x',0), verts[0]['y']
-                right, bottom = verts[2]['x'], verts[2]['y']
-            except KeyError:
-                left, top, bottom, right=0,0,0,0
-            rect = [left,top,right,bottom]
-            tokens.append(Token(rect, word['symbols'], word['confidence']))
-    return tokens
+            rectangles.append(get_word_rectangle(word))
+            texts.append(get_word_text(word))
+            confidences.append(word['confidence'])
+    return TokenArray.from_rectangles(rectangles, texts, confidences)
 
 def flatten_list(l: list):
     return [x for y in l for x in y]
 
-def join_all_pages(prefix: str):
-    pages = []
+def parse_page_ranges(spec: str):
+    """Parses page selections like "1-50,120,300-" into (first, last) pairs, last being None for open ranges."""
+    ranges = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        first, separator, last = part.partition('-')
+        first = int(first) if first else 1
+        last = (int(last) if last else None) if separator else first
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f'Invalid page range: {part}')
+        ranges.append((first, last))
+    return ranges
+
+def select_pages(page_count: int, ranges=None):
+    if not ranges:
+        return list(range(1, page_count + 1))
+    return sorted({page_number
+                   for first, last in ranges
+                   for page_number in range(first, min(last or page_count, page_count) + 1)})
+
+def get_peak_rss_mb():
+    # VmHWM is the peak resident set size of this process (since start or since the last reset_peak_rss)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def chunked(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def iter_ocred_pages(prefix: str):
     for file in sorted(glob(f'{config.OCRED_PAGES_DIR}/{prefix}*'), 
                        key=lambda filename: int(filename.split('-')[1])):
         data = open_results_file(file)
-        pages.extend(sorted(
+        yield from sorted(
             data['responses'], 
-            key= lambda response: response['context']['pageNumber']))
+            key= lambda response: response['context']['pageNumber'])
+
+def join_all_pages(prefix: str):
     # assert [page['context']['pageNumber'] for page in pages] == list(range(1, len(pages) + 1)), 'Missing page'
-    with open(f'{config.JOINED_OCRED_DIR}/{prefix}.json', 'w') as f:
-        f.write(json.dumps(pages))
+    writer = ocr_store.OcrStoreWriter(ocr_store.get_store_path(prefix))
+    export = open(f'{config.JOINED_OCRED_DIR}/{prefix}.json', 'w') if config.EXPORT_JOINED_JSON else None
+    try:
+        if export: export.write('[')
+        for index, response in enumerate(iter_ocred_pages(prefix)):
+            writer.add(response)
+            metrics.count('joined_pages')
+            if export:
+                export.write((', ' if index else '') + json.dumps(response))
+        if export: export.write(']')
+    finally:
+        if export: export.close()
+    writer.close()
+
+def iter_json_array(filepath: str, chunk_size: int = 2**20):
+    """Yields the items of a top-level JSON array one at a time, without loading the whole file."""
+    decoder = json.JSONDecoder()
+    with open(filepath, encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'{filepath} does not contain a JSON array')
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip(', \t\r\n')
+            if buffer.startswith(']'):
+                return
+            try:
+                if not buffer:
+                    raise json.JSONDecodeError('Incomplete item', buffer, 0)
+                item, end = decoder.raw_decode(buffer)
+                if end == len(buffer) and not eof:
+                    # A number cut by the end of the buffer still decodes (12345 read as 12): only an item
+                    # followed by something else is known to be complete
+                    raise json.JSONDecodeError('Possibly incomplete item', buffer, end)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Item spans past the buffer: reading as much as is already buffered keeps the re-parsing linear
+                more = f.read(max(chunk_size, len(buffer)))
+                eof = not more
+                buffer += more
+                continue
+            yield item
+            buffer = buffer[end:]
+
+def split_page(response: Dict):
+    text_annotation = response.get('fullTextAnnotation')
+    if not text_annotation:
+        return {'pages': None}, {}
+    page_annotation = text_annotation['pages'][0]
+    metadata = {key: value for key, value in page_annotation.items() if key != 'blocks'}
+    metadata = {**response.get('context', {}), **metadata}
+    return page_annotation, metadata
 
 def get_pages_from_file(filepath: str):
-    blank_page = {'pages': None}
-    for page in open_results_file(filepath):
-        text_annotation = page.get('fullTextAnnotation')
-        if not text_annotation:
-            yield blank_page, {}
-            continue
-        metadata = text_annotation['pages'][0]
-        pages = deepcopy(text_annotation)['pages']
-        if metadata.get('blocks'):
-            del metadata['blocks']
-        metadata = {**page.get('context', {}), **metadata}
-        yield pages[0], metadata
-
-def get_google_vision_response(filepath, batch_size=100):
-    os.system(f'gsutil -m cp {filepath} gs://{config.BUCKET_NAME}')
-    mime_type = "application/pdf"
-    
-    client = vision.ImageAnnotatorClient()
-    
-    
-    
-    feature = vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)
-    gcs_source = vision.GcsSource(uri=f"gs://{config.BUCKET_NAME}/{filepath.name}")
-    input_config = vision.InputConfig(gcs_source=gcs_source, mime_type=mime_type)
-    gcs_destination = vision.GcsDestination(uri=f"gs://{config.BUCKET_NAME}/{filepath.with_suffix('.json').name}")
-    
-    output_config = vision.OutputConfig(
-        gcs_destination=gcs_destination, batch_size=batch_size
-    )
-    
-    text_detection_params = vision.TextDetectionParams(enable_text_detection_confidence_score=True)
-    image_context = vision.ImageContext(text_detection_params=text_detection_params)
-    async_request = vision.AsyncAnnotateFileRequest(
-        features=[feature], input_config=input_config, output_config=output_config, image_context=image_context
-    )
-    operation = client.async_batch_annotate_files(requests=[async_request])
-    print("Waiting for the operation to finish.")
-    operation.result(timeout=420)
-    os.system(f'gsutil -m cp gs://{config.BUCKET_NAME}/{filepath.with_suffix(".json").name.replace(".json","*.json")} {config.OCRED_PAGES_DIR}')
-
-# get_google_vision_response(Path(f'{config.DESKEWED_FILES_DIR}/teste9.pdf'))
\ No newline at end of file
+    for response in iter_json_array(filepath):
+        yield split_page(response)
+
+def get_google_vision_responses(filepaths):
+    """OCRs many PDFs concurrently with Google Vision, returning a {filepath: error or None} dict."""
+    client = ocr_client.OcrClient(ocr_client.GcsObjectStore(), ocr_client.VisionAnnotator())
+    return asyncio.run(client.run(filepaths))
+
+def get_google_vision_response(filepath):
+    error = get_google_vision_responses([filepath])[filepath]
+    if error:
+        raise RuntimeError(error)
+
+# get_google_vision_response(Path(f'{config.DESKEWED_FILES_DIR}/teste9.pdf'))
@@ -0,0 +1,141 @@
+import os
+import logging
+from pathlib import Path
+
+import config
+import pdfilust
+
+logger = logging.getLogger("table_generator")
+
+RECORD_FIELDS = ('document', 'page', 'table', 'row', 'column', 'text', 'confidence', 'token_confidences')
+
+class CsvWriter:
+    """One CSV per table and page in OUTPUT_TABLES_FILES_DIR, written as soon as the table is extracted."""
+    output = 'csv'
+
+    def write(self, table):
+        table.save_csv()
+
+    def drain(self):
+        return []
+
+class RecordCollector:
+    """Keeps the cell records of the tables extracted by a worker, to be sent back to the process writing the document."""
+    output = 'parquet'
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, table):
+        self.records.extend(table.get_records())
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+class OverlayCollector(RecordCollector):
+    """Keeps the debug overlay of each page (see pdfilust.py), drawn into the document's overlay PDF by the main process."""
+    output = 'grid'
+
+    def write(self, table):
+        self.records.append(pdfilust.get_page_overlay(table))
+
+def get_page_writers(formats=config.OUTPUT_FORMATS, grid=config.GRID):
+    # Writers used next to the extraction (possibly in a worker). Whole document files can't be shared
+    # between workers, so their records are collected and written by the main process
+    writers = []
+    if 'csv' in formats:
+        writers.append(CsvWriter())
+    if 'parquet' in formats:
+        writers.append(RecordCollector())
+    if grid:
+        writers.append(OverlayCollector())
+    return writers
+
+def drain_records(page_writers):
+    # Records of every writer, by the output they go to
+    records = {}
+    for writer in page_writers:
+        records.setdefault(writer.output, []).extend(writer.drain())
+    return records
+
+def get_csv_files(prefix: str):
+    # CSV files of a document by page ({prefix}---{page:04}_{table:02}.csv), listing the directory once
+    files = {}
+    for path in Path(config.OUTPUT_TABLES_FILES_DIR).glob(f'{prefix}---*_*.csv'):
+        page = path.stem[len(prefix) + 3:].split('_')[0]
+        if page.isdigit():
+            files.setdefault(int(page), []).append(path)
+    return files
+
+def get_parquet_path(prefix: str):
+    return Path(config.OUTPUT_TABLES_FILES_DIR) / f'{prefix}.parquet'
+
+class ParquetWriter:
+    """Cells of a whole document in a single Parquet file, one record per non-empty cell (RECORD_FIELDS).
+    Records are buffered and appended as row groups of row_group_size. The file is written aside and renamed on close;
+    records of the pages that aren't in replace_pages are carried over from the previous file, so a run that only
+    rebuilds stale pages keeps the others."""
+
+    def __init__(self, path, replace_pages=None, row_group_size=config.PARQUET_ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('Parquet output needs pyarrow ("poetry install --extras parquet")') from e
+        self.pa = pyarrow
+        self.path = Path(path)
+        self.tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.schema = pyarrow.schema([
+            ('document', pyarrow.string()),
+            ('page', pyarrow.int32()),
+            ('table', pyarrow.int16()),
+            ('row', pyarrow.int32()),
+            ('column', pyarrow.int16()),
+            ('text', pyarrow.string()),
+            ('confidence', pyarrow.float32()),
+            ('token_confidences', pyarrow.list_(pyarrow.float32())),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(self.tmp_path, self.schema, compression='zstd')
+        if self.path.exists():
+            self._carry_over(replace_pages)
+
+    def _carry_over(self, replace_pages):
+        replaced = self.pa.array(sorted(replace_pages or []), self.pa.int32())
+        previous = self.pa.parquet.ParquetFile(self.path)
+        if previous.schema_arrow != self.schema:
+            logger.warning(f'{self.path.name} was written with another layout, rewriting it')
+            return
+        for batch in previous.iter_batches(batch_size=self.row_group_size):
+            kept = batch.filter(self.pa.compute.invert(self.pa.compute.is_in(batch['page'], value_set=replaced)))
+            if kept.num_rows:
+                self.writer.write_batch(kept, row_group_size=self.row_group_size)
+
+    def write(self, table):
+        self.extend(table.get_records())
+
+    def extend(self, records):
+        self.buffer.extend(records)
+        while len(self.buffer) >= self.row_group_size:
+            self.flush(self.row_group_size)
+
+    def flush(self, size=None):
+        records, self.buffer = self.buffer[:size], self.buffer[len(self.buffer) if size is None else size:]
+        if records:
+            columns = [list(column) for column in zip(*records)]
+            self.writer.write_table(self.pa.Table.from_arrays(
+                [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema), row_group_size=self.row_group_size)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.tmp_path.replace(self.path)
+
+    def abort(self):
+        # Leaves the previous file as it was
+        self.writer.close()
+        self.tmp_path.unlink(missing_ok=True)